@@ -0,0 +1,168 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from datetime import datetime
+from typing import Deque, Dict, List, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+
+import database as db
+from config import ADMIN_IDS, ADMIN_BOARD_INTERVAL, ADMIN_BOARD_PAID_HOURS
+
+# Сколько заявок каждого вида и последних изменений показывать на доске
+PENDING_LINES = 15
+PAID_LINES = 5
+CHANGE_LINES = 10
+# Через сколько секунд снова пробовать показать доску админу, которому она не доставилась
+# (например, админ не запускал бота)
+FAILED_RETRY = 60 * 60
+
+
+def _order_line(order: Dict) -> str:
+    currency = (order['currency_code'] or '').upper()
+    return f"№ {order['order_number']} — {order['product_name'] or '?'} — {order['amount_currency']} {currency}"
+
+
+class AdminBoard:
+    """Доска заявок: одно закрепленное сообщение у каждого админа.
+
+    Раз в interval секунд читается снимок заявок (ожидающие оплаты и оплаченные
+    за последние часы) и сравнивается с предыдущим: так получаются последние
+    изменения, сколько бы их ни накопилось между обновлениями. Сообщение
+    редактируется, только если изменились строки заявок или последних изменений
+    (время обновления в заголовке не сравнивается), поэтому число запросов
+    к Telegram не зависит от количества заявок.
+    """
+
+    def __init__(self, interval: float, paid_window_hours: int):
+        self.interval = interval
+        self.paid_window_hours = paid_window_hours
+        self._bot: Optional[Bot] = None
+        self._admins: List[int] = []
+        self._task: Optional[asyncio.Task] = None
+        self._snapshot: Optional[Dict[int, str]] = None
+        self._changes: Deque[str] = deque(maxlen=CHANGE_LINES)
+        self._shown: Dict[int, str] = {}
+        # Админы, которым доска не доставилась: admin_id -> время следующей попытки
+        self._failed: Dict[int, float] = {}
+        self._paused_until = 0.0
+
+    async def start(self, bot: Bot, shard: Optional[Tuple[int, int]] = None):
+        """shard = (номер, всего): вести доски только админов своего обработчика"""
+        self._bot = bot
+        self._admins = [admin_id for admin_id in ADMIN_IDS if shard is None or admin_id % shard[1] == shard[0]]
+        if self._admins:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception:
+                logging.exception('Ошибка обновления доски заявок')
+            await asyncio.sleep(self.interval)
+
+    async def refresh(self):
+        orders = await db.get_board_orders(self.paid_window_hours)
+        self._track_changes(orders)
+        body = self._render(orders)
+        for admin_id in self._admins:
+            if time.time() < self._paused_until:
+                return
+            if self._failed.get(admin_id, 0) > time.time():
+                continue
+            if self._shown.get(admin_id) != body:
+                await self._show(admin_id, body)
+
+    def _track_changes(self, orders: List[Dict]):
+        """Изменения между двумя снимками (номер заявки -> статус)"""
+        snapshot = {order['order_number']: order['status'] for order in orders}
+        previous, self._snapshot = self._snapshot, snapshot
+        if previous is None:
+            return
+        created, paid, cancelled = [], [], []
+        for order_number in sorted(previous.keys() | snapshot.keys()):
+            before, after = previous.get(order_number), snapshot.get(order_number)
+            if before == after:
+                continue
+            if after == 'paid':
+                paid.append(order_number)
+            elif after == 'pending':
+                created.append(order_number)
+            elif before == 'pending':
+                # Пропала из ожидающих, не оплатившись
+                cancelled.append(order_number)
+
+        # Все изменения одного вида между обновлениями - одной строкой
+        stamp = datetime.now().strftime('%H:%M')
+        for icon, title, numbers in (('🆕', 'новые', created), ('❌', 'отменены', cancelled), ('✅', 'оплачены', paid)):
+            if not numbers:
+                continue
+            if len(numbers) <= 3:
+                listed = ', '.join(f'№ {number}' for number in numbers)
+                self._changes.appendleft(f"{stamp} {icon} {title}: {listed}")
+            else:
+                self._changes.appendleft(f"{stamp} {icon} {title}: {len(numbers)} заявок")
+
+    def _render(self, orders: List[Dict]) -> str:
+        """Текст доски без заголовка: по нему решается, нужно ли редактировать сообщение"""
+        pending = [order for order in orders if order['status'] == 'pending']
+        paid = [order for order in orders if order['status'] == 'paid']
+
+        lines = [f"⏳ Ожидают оплаты: {len(pending)}"]
+        lines.extend(_order_line(order) for order in pending[:PENDING_LINES])
+        if len(pending) > PENDING_LINES:
+            lines.append(f"... и еще {len(pending) - PENDING_LINES}")
+
+        lines.append("")
+        lines.append(f"✅ Оплачено за {self.paid_window_hours} ч: {len(paid)}")
+        lines.extend(_order_line(order) for order in paid[:PAID_LINES])
+
+        if self._changes:
+            lines.append("")
+            lines.append("🔔 Последние изменения:")
+            lines.extend(self._changes)
+        return "\n".join(lines)
+
+    async def _show(self, admin_id: int, body: str):
+        text = f"📋 Заявки (обновлено {datetime.now().strftime('%H:%M')})\n\n{body}"
+        key = f'admin_board:{admin_id}'
+        message_id = await db.get_setting(key)
+        try:
+            if message_id:
+                try:
+                    await self._bot.edit_message_text(text, chat_id=admin_id, message_id=int(message_id))
+                except TelegramBadRequest as e:
+                    if 'not modified' in str(e):
+                        pass
+                    elif 'not found' in str(e) or "can't be edited" in str(e):
+                        # Сообщение удалили - создадим новое
+                        message_id = None
+                    else:
+                        raise
+            if not message_id:
+                message = await self._bot.send_message(admin_id, text)
+                await self._bot.pin_chat_message(admin_id, message.message_id, disable_notification=True)
+                await db.set_setting(key, str(message.message_id))
+            self._shown[admin_id] = body
+            self._failed.pop(admin_id, None)
+        except TelegramRetryAfter as e:
+            self._paused_until = time.time() + e.retry_after
+        except (TelegramForbiddenError, TelegramBadRequest) as e:
+            self._failed[admin_id] = time.time() + FAILED_RETRY
+            logging.warning('Не удалось обновить доску заявок админа %s: %s (следующая попытка через %s с)',
+                            admin_id, e, FAILED_RETRY)
+
+
+admin_board = AdminBoard(ADMIN_BOARD_INTERVAL, ADMIN_BOARD_PAID_HOURS)
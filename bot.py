@@ -1,15 +1,29 @@
 import asyncio
 import logging
+import signal
 from aiogram import Bot, Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.client.session.aiohttp import AiohttpSession
 
-from config import BOT_TOKEN, PROXY_URL
+from config import (BOT_TOKEN, PROXY_URL, FSM_STORAGE, FSM_FLUSH_INTERVAL,
+                    FSM_SESSION_TTL, FSM_DEFAULT_TTL, FSM_SWEEP_INTERVAL,
+                    BOT_MODE, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_HOST, PORT,
+                    BOT_WORKERS, BOT_WORKER_INDEX, WORKER_PORT_BASE, CACHE_SYNC_INTERVAL, ADMIN_BOARD,
+                    USER_FLUSH_INTERVAL)
 import database as db
+from board import admin_board
 from handlers import client, admin
+from middlewares import BlockedUserMiddleware
+from outbox import outbox
+from scheduler import payment_timeouts
+from sharding import WorkerPool, WORKER_PATH, poll_updates
+from storage import SQLiteStorage, MemoryTTLStorage, run_session_sweeper
+from webhook import create_health_app, create_webhook_app, create_front_app, start_server
 
 # Настройка логирования
-logging.basicConfig(level=logging.INFO)
+if BOT_WORKER_INDEX is None:
+    logging.basicConfig(level=logging.INFO)
+else:
+    logging.basicConfig(level=logging.INFO, format=f'[worker {BOT_WORKER_INDEX}] %(levelname)s:%(name)s:%(message)s')
 
 # Инициализация бота с прокси (если задан)
 if PROXY_URL:
@@ -17,22 +31,151 @@ if PROXY_URL:
     bot = Bot(token=BOT_TOKEN, session=session)
 else:
     bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
+# Состояния диалогов: в SQLite (переживают перезапуск) или только в памяти
+if FSM_STORAGE == 'memory':
+    storage = MemoryTTLStorage(FSM_SESSION_TTL, FSM_DEFAULT_TTL)
+else:
+    storage = SQLiteStorage(FSM_FLUSH_INTERVAL, FSM_SESSION_TTL, FSM_DEFAULT_TTL)
 dp = Dispatcher(storage=storage)
 
+# Заблокированные клиенты не доходят ни до одного обработчика
+dp.update.outer_middleware(BlockedUserMiddleware())
+
 # Подключение роутеров
 dp.include_router(client.router)
 dp.include_router(admin.router)
 
+async def wait_for_stop():
+    """Ждать SIGTERM/SIGINT (хостинг останавливает сервис через SIGTERM)"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+async def set_webhook():
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+    else:
+        logging.warning('WEBHOOK_URL не задан: вебхук не зарегистрирован, принимаются только локальные запросы')
+
+async def run_polling():
+    """Получение обновлений через long polling"""
+    # Если раньше был вебхук, Telegram не отдаст обновления через getUpdates
+    await bot.delete_webhook()
+    runner = await start_server(create_health_app(), WEBHOOK_HOST, int(PORT)) if PORT else None
+    try:
+        await dp.start_polling(bot)
+    finally:
+        if runner:
+            await runner.cleanup()
+
+async def run_webhook():
+    """Получение обновлений через вебхук на встроенном aiohttp-сервере"""
+    app = create_webhook_app(bot, dp, WEBHOOK_PATH, WEBHOOK_SECRET)
+    runner = await start_server(app, WEBHOOK_HOST, int(PORT or 8080))
+    try:
+        await set_webhook()
+        await wait_for_stop()
+    finally:
+        await runner.cleanup()
+        await bot.session.close()
+
+async def run_worker():
+    """Обработчик: принимает от главного процесса обновления своих клиентов"""
+    app = create_webhook_app(bot, dp, WORKER_PATH, WEBHOOK_SECRET)
+    runner = await start_server(app, '127.0.0.1', WORKER_PORT_BASE + BOT_WORKER_INDEX)
+    try:
+        await wait_for_stop()
+    finally:
+        await runner.cleanup()
+        await bot.session.close()
+
+async def run_front():
+    """Главный процесс: получает обновления и раздает их обработчикам"""
+    pool = WorkerPool(BOT_WORKERS, WORKER_PORT_BASE, WEBHOOK_SECRET)
+    await pool.start()
+    print(f"🤖 Бот запущен! Обработчиков: {BOT_WORKERS}")
+    runner = None
+    polling = None
+    try:
+        if BOT_MODE == 'webhook':
+            app = create_front_app(pool.dispatch, WEBHOOK_PATH, WEBHOOK_SECRET)
+            runner = await start_server(app, WEBHOOK_HOST, int(PORT or 8080))
+            await set_webhook()
+        else:
+            await bot.delete_webhook()
+            if PORT:
+                runner = await start_server(create_health_app(), WEBHOOK_HOST, int(PORT))
+            polling = asyncio.create_task(poll_updates(bot, pool, dp.resolve_used_update_types()))
+        await wait_for_stop()
+    finally:
+        if polling:
+            polling.cancel()
+        if runner:
+            await runner.cleanup()
+        await pool.stop()
+        await bot.session.close()
+
 async def main():
     """Запуск бота"""
-    # Инициализация базы данных
-    await db.init_db()
-    
-    print("🤖 Бот запущен!")
+    if BOT_WORKERS > 1 and BOT_WORKER_INDEX is None:
+        await run_front()
+        return
     
-    # Запуск polling
-    await dp.start_polling(bot)
+    shard = None
+    tasks = []
+    # Запуск тоже внутри try: при ошибке уже запущенное будет остановлено,
+    # иначе незакрытые соединения с базой не дадут процессу завершиться
+    try:
+        # Инициализация базы данных
+        await db.init_db()
+        
+        if BOT_WORKER_INDEX is not None:
+            shard = (BOT_WORKER_INDEX, BOT_WORKERS)
+            # Изменения каталога и настроек, сделанные в других обработчиках
+            await db.enable_cache_sync()
+            tasks.append(asyncio.create_task(db.run_cache_sync(CACHE_SYNC_INTERVAL)))
+        
+        # Очередь уведомлений (досылает то, что не успели отправить до перезапуска)
+        await outbox.start(bot, shard)
+        
+        # Таймеры оплаты (восстанавливаются из неоплаченных заявок своих клиентов)
+        await payment_timeouts.start(bot, dp.storage, shard)
+        
+        # Доска заявок у админов
+        if ADMIN_BOARD:
+            await admin_board.start(bot, shard)
+        
+        # Удаление брошенных диалогов
+        tasks.append(asyncio.create_task(run_session_sweeper(storage, FSM_SWEEP_INTERVAL)))
+        
+        # Отложенная запись профилей клиентов
+        tasks.append(asyncio.create_task(db.run_user_flush(USER_FLUSH_INTERVAL)))
+        
+        if BOT_WORKER_INDEX is None:
+            print("🤖 Бот запущен!")
+        
+        if BOT_WORKER_INDEX is not None:
+            await run_worker()
+        elif BOT_MODE == 'webhook':
+            await run_webhook()
+        else:
+            await run_polling()
+    finally:
+        await payment_timeouts.stop()
+        await admin_board.stop()
+        await outbox.stop()
+        for task in tasks:
+            task.cancel()
+        # Сохраняем несохраненные состояния диалогов
+        await storage.close()
+        # Закрываем соединения с базой данных
+        await db.close_db()
 
 if __name__ == '__main__':
     asyncio.run(main())
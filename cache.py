@@ -0,0 +1,74 @@
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Iterable, Set, Tuple
+
+
+class CatalogCache:
+    """LRU-кэш запросов витрины с инвалидацией по тегам.
+
+    Каждая запись помечается тегами вида ('city', 5) или ('product', 12);
+    изменение данных сбрасывает только записи с соответствующими тегами.
+    Результат чтения сохраняется, только если за время запроса не было
+    ни одной инвалидации (иначе в кэш могли бы попасть устаревшие данные).
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max(1, max_entries)
+        self._entries: "OrderedDict[Hashable, Tuple[Any, Tuple]]" = OrderedDict()
+        self._by_tag: Dict[Hashable, Set[Hashable]] = {}
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable) -> Tuple[bool, Any]:
+        """(найдено, значение)"""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return False, None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return True, entry[0]
+
+    def put(self, key: Hashable, value: Any, tags: Iterable[Hashable], generation: int):
+        if generation != self.generation:
+            return
+        self._discard(key)
+        tags = tuple(set(tags))
+        self._entries[key] = (value, tags)
+        for tag in tags:
+            self._by_tag.setdefault(tag, set()).add(key)
+        while len(self._entries) > self.max_entries:
+            oldest = next(iter(self._entries))
+            self._discard(oldest)
+            self.evictions += 1
+
+    def invalidate(self, *tags: Hashable):
+        self.generation += 1
+        for tag in tags:
+            for key in list(self._by_tag.get(tag, ())):
+                self._discard(key)
+
+    def clear(self):
+        self.generation += 1
+        self._entries.clear()
+        self._by_tag.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def _discard(self, key: Hashable):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry[1]:
+            keys = self._by_tag.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_tag[tag]
@@ -0,0 +1,109 @@
+import heapq
+import json
+import re
+from typing import Dict, Iterable, List, Optional, Set
+
+# Все, что не буква и не цифра, считаем разделителем
+_SEPARATORS = re.compile(r'[\W_]+')
+
+# Сколько лучших по числу общих триграмм кандидатов проверять расстоянием Левенштейна
+_FUZZY_CANDIDATES = 8
+
+def normalize_city_name(text: str) -> str:
+    """Нормализованное написание: без регистра, ё -> е, без пунктуации и лишних пробелов"""
+    text = text.casefold().replace('ё', 'е')
+    return ' '.join(_SEPARATORS.sub(' ', text).split())
+
+def _trigrams(key: str) -> Set[str]:
+    padded = f'  {key} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def _max_typos(length: int) -> int:
+    """Допустимое число опечаток в зависимости от длины названия"""
+    if length <= 3:
+        return 0
+    if length <= 5:
+        return 1
+    if length <= 9:
+        return 2
+    return 3
+
+def _levenshtein(a: str, b: str, limit: int) -> int:
+    """Расстояние Левенштейна; если оно больше limit, возвращает limit + 1"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+class CityIndex:
+    """Индекс городов в памяти: нормализованное название/вариант написания -> город.
+
+    Для поиска с опечатками хранит триграммный индекс ключей: кандидаты
+    отбираются по числу общих триграмм, а проверяются расстоянием Левенштейна.
+    """
+
+    def __init__(self):
+        self._by_key: Dict[str, Dict] = {}
+        self._by_trigram: Dict[str, List[str]] = {}
+
+    def rebuild(self, cities: Iterable[Dict]):
+        """Построить индекс заново и атомарно заменить старый"""
+        cities = list(cities)
+        by_key: Dict[str, Dict] = {}
+        # Официальные названия важнее вариантов написания
+        for city in cities:
+            key = normalize_city_name(city['name'])
+            if key:
+                by_key.setdefault(key, city)
+        for city in cities:
+            for alias in json.loads(city['aliases'] or '[]'):
+                key = normalize_city_name(alias)
+                if key:
+                    by_key.setdefault(key, city)
+        by_trigram: Dict[str, List[str]] = {}
+        for key in by_key:
+            for trigram in _trigrams(key):
+                by_trigram.setdefault(trigram, []).append(key)
+        self._by_key, self._by_trigram = by_key, by_trigram
+
+    def find(self, query: str) -> Optional[Dict]:
+        city = self._by_key.get(normalize_city_name(query))
+        return dict(city) if city else None
+
+    def find_similar(self, query: str) -> Optional[Dict]:
+        """Ближайший город с учетом опечаток (или None, если похожих нет)"""
+        key = normalize_city_name(query)
+        by_key, by_trigram = self._by_key, self._by_trigram
+        limit = _max_typos(len(key))
+        if not limit:
+            return None
+
+        query_trigrams = _trigrams(key)
+        # Каждая правка портит не больше трех триграмм
+        needed = max(1, len(query_trigrams) - 3 * limit)
+        shared: Dict[str, int] = {}
+        for trigram in query_trigrams:
+            for candidate in by_trigram.get(trigram, ()):
+                shared[candidate] = shared.get(candidate, 0) + 1
+        candidates = [
+            (count, candidate) for candidate, count in shared.items()
+            if count >= needed and abs(len(candidate) - len(key)) <= limit
+        ]
+
+        best = None
+        for count, candidate in heapq.nlargest(_FUZZY_CANDIDATES, candidates):
+            distance = _levenshtein(key, candidate, limit)
+            if distance <= limit and (best is None or distance < best[0]):
+                best = (distance, candidate)
+        return dict(by_key[best[1]]) if best else None
+
+    def __len__(self):
+        return len(self._by_key)
@@ -1,4 +1,5 @@
 import os
+import hashlib
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -7,8 +8,95 @@ BOT_TOKEN = os.getenv('BOT_TOKEN')
 ADMIN_IDS = [int(id) for id in os.getenv('ADMIN_IDS', '').split(',') if id]
 PROXY_URL = os.getenv('PROXY_URL')
 
+# Режим получения обновлений: polling или webhook
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+# Публичный адрес сервиса (на Render подставляется автоматически)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL') or os.getenv('RENDER_EXTERNAL_URL')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+# Секрет, который Telegram присылает в заголовке X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or hashlib.sha256((BOT_TOKEN or '').encode()).hexdigest()
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+# Порт HTTP-сервера; в режиме polling сервер (только /health) запускается, если порт задан
+PORT = os.getenv('PORT')
+
+# Количество процессов-обработчиков. При значении больше 1 главный процесс только
+# получает обновления и раздает их обработчикам по user_id % BOT_WORKERS
+BOT_WORKERS = int(os.getenv('BOT_WORKERS', '1'))
+# Номер обработчика (задается главным процессом, вручную не указывать)
+BOT_WORKER_INDEX = int(os.environ['BOT_WORKER_INDEX']) if os.getenv('BOT_WORKER_INDEX') else None
+# Обработчик с номером i слушает 127.0.0.1:(WORKER_PORT_BASE + i)
+WORKER_PORT_BASE = int(os.getenv('WORKER_PORT_BASE', '8100'))
+# Как часто (в секундах) обработчики применяют сбросы кэша, сделанные другими процессами
+CACHE_SYNC_INTERVAL = float(os.getenv('CACHE_SYNC_INTERVAL', '1'))
+
 # Начальный номер заявки
 INITIAL_ORDER_NUMBER = 10207903
 
 # Время на оплату (в секундах)
 PAYMENT_TIMEOUT = 30 * 60  # 30 минут
+
+# Количество постоянных соединений с базой данных
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '4'))
+
+# Максимум операций записи, объединяемых в одну транзакцию
+DB_WRITE_BATCH_SIZE = int(os.getenv('DB_WRITE_BATCH_SIZE', '64'))
+
+# Профиль хранилища SQLite (применяется при запуске)
+DB_STORAGE_PROFILE = {
+    'journal_mode': os.getenv('DB_JOURNAL_MODE', 'WAL'),
+    'synchronous': os.getenv('DB_SYNCHRONOUS', 'NORMAL'),
+    'mmap_size': int(os.getenv('DB_MMAP_SIZE', str(64 * 1024 * 1024))),
+    'cache_size': int(os.getenv('DB_CACHE_SIZE', '-16000')),  # отрицательное значение - в КиБ
+    'auto_vacuum': os.getenv('DB_AUTO_VACUUM', 'INCREMENTAL'),
+}
+
+# Через сколько секунд простоя писателя выполнять checkpoint WAL и incremental vacuum
+DB_MAINTENANCE_IDLE = float(os.getenv('DB_MAINTENANCE_IDLE', '30'))
+# Сколько свободных страниц возвращать за один проход incremental vacuum
+DB_VACUUM_PAGES = int(os.getenv('DB_VACUUM_PAGES', '1000'))
+
+# Максимум записей в кэше запросов витрины
+CATALOG_CACHE_SIZE = int(os.getenv('CATALOG_CACHE_SIZE', '2048'))
+
+# Как часто (в секундах) проверять просроченные заявки, даже если таймеров нет
+ORDER_SWEEP_INTERVAL = float(os.getenv('ORDER_SWEEP_INTERVAL', '60'))
+# Очередь исходящих сообщений: сообщений в секунду (на всего бота),
+# минимальный интервал между сообщениями в один чат и число попыток
+OUTBOX_RATE_LIMIT = float(os.getenv('OUTBOX_RATE_LIMIT', '25'))
+OUTBOX_CHAT_INTERVAL = float(os.getenv('OUTBOX_CHAT_INTERVAL', '1'))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '10'))
+
+# Профили клиентов (/start) записываются в базу пачками: раз в USER_FLUSH_INTERVAL
+# секунд или сразу, когда набралось USER_FLUSH_BATCH изменившихся профилей
+USER_FLUSH_INTERVAL = float(os.getenv('USER_FLUSH_INTERVAL', '2'))
+USER_FLUSH_BATCH = int(os.getenv('USER_FLUSH_BATCH', '500'))
+# Сколько последних профилей помнить, чтобы не перезаписывать неизменившиеся
+USER_FINGERPRINT_CACHE_SIZE = int(os.getenv('USER_FINGERPRINT_CACHE_SIZE', '100000'))
+
+# Импорт (/import_catalog, /import_data): сколько строк вставлять одним executemany
+# и как часто (в секундах) сообщать админу о ходе импорта
+IMPORT_BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', '5000'))
+IMPORT_PROGRESS_INTERVAL = float(os.getenv('IMPORT_PROGRESS_INTERVAL', '3'))
+
+# Доска заявок: одно закрепленное сообщение у каждого админа вместо уведомления
+# о каждой оплате. Сообщение обновляется не чаще раза в ADMIN_BOARD_INTERVAL секунд
+ADMIN_BOARD = os.getenv('ADMIN_BOARD', '0') == '1'
+ADMIN_BOARD_INTERVAL = float(os.getenv('ADMIN_BOARD_INTERVAL', '15'))
+# За сколько часов показывать оплаченные заявки
+ADMIN_BOARD_PAID_HOURS = int(os.getenv('ADMIN_BOARD_PAID_HOURS', '24'))
+
+# Хранилище состояний диалогов: sqlite (переживает перезапуск) или memory
+FSM_STORAGE = os.getenv('FSM_STORAGE', 'sqlite')
+# Как часто (в секундах) сбрасывать измененные состояния диалогов в базу
+FSM_FLUSH_INTERVAL = float(os.getenv('FSM_FLUSH_INTERVAL', '1'))
+
+# Через сколько секунд без изменений удалять брошенный диалог (по группе состояний).
+# Для клиентов срок должен быть больше PAYMENT_TIMEOUT, иначе пропадет ожидание оплаты.
+FSM_SESSION_TTL = {
+    'OrderStates': float(os.getenv('FSM_ORDER_TTL', str(2 * 60 * 60))),
+    'AdminStates': float(os.getenv('FSM_ADMIN_TTL', str(6 * 60 * 60))),
+}
+# Срок для данных без состояния и для прочих групп
+FSM_DEFAULT_TTL = float(os.getenv('FSM_DEFAULT_TTL', str(2 * 60 * 60)))
+# Как часто (в секундах) искать брошенные диалоги
+FSM_SWEEP_INTERVAL = float(os.getenv('FSM_SWEEP_INTERVAL', '300'))
@@ -1,173 +1,725 @@
+import asyncio
+import gzip
+import logging
 import aiosqlite
 import json
-from typing import List, Dict, Optional
+import os
+import secrets
+import sqlite3
+import tempfile
+import time
+from contextlib import asynccontextmanager
+from itertools import islice
+from typing import List, Dict, Optional, Set, Callable, Awaitable, Iterable
 from datetime import datetime
 
+from cache import CatalogCache
+from city_search import CityIndex
+from config import (
+    DB_POOL_SIZE, DB_WRITE_BATCH_SIZE, DB_STORAGE_PROFILE, DB_MAINTENANCE_IDLE, DB_VACUUM_PAGES,
+    CATALOG_CACHE_SIZE, INITIAL_ORDER_NUMBER, USER_FLUSH_BATCH, USER_FINGERPRINT_CACHE_SIZE,
+    IMPORT_BATCH_SIZE
+)
+
 DB_NAME = 'shop_bot.db'
 
+_JOURNAL_MODES = {'DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF'}
+_SYNCHRONOUS_LEVELS = {'OFF', 'NORMAL', 'FULL', 'EXTRA'}
+_AUTO_VACUUM_MODES = {'NONE': 0, 'FULL': 1, 'INCREMENTAL': 2}
+
+def _storage_profile() -> Dict:
+    """Проверенный профиль хранилища из конфига"""
+    profile = {
+        'journal_mode': str(DB_STORAGE_PROFILE['journal_mode']).upper(),
+        'synchronous': str(DB_STORAGE_PROFILE['synchronous']).upper(),
+        'mmap_size': int(DB_STORAGE_PROFILE['mmap_size']),
+        'cache_size': int(DB_STORAGE_PROFILE['cache_size']),
+        'auto_vacuum': str(DB_STORAGE_PROFILE['auto_vacuum']).upper(),
+    }
+    if profile['journal_mode'] not in _JOURNAL_MODES:
+        raise ValueError(f"Неизвестный journal_mode: {profile['journal_mode']}")
+    if profile['synchronous'] not in _SYNCHRONOUS_LEVELS:
+        raise ValueError(f"Неизвестный уровень synchronous: {profile['synchronous']}")
+    if profile['auto_vacuum'] not in _AUTO_VACUUM_MODES:
+        raise ValueError(f"Неизвестный режим auto_vacuum: {profile['auto_vacuum']}")
+    return profile
+
+async def _configure_storage(profile: Dict):
+    """Постоянные настройки файла базы: auto_vacuum и режим журнала"""
+    async with aiosqlite.connect(DB_NAME, timeout=30.0, isolation_level=None) as conn:
+        async with conn.execute('PRAGMA auto_vacuum') as cursor:
+            current = (await cursor.fetchone())[0]
+        wanted = _AUTO_VACUUM_MODES[profile['auto_vacuum']]
+        if current != wanted:
+            # Для уже созданной базы режим меняется только через VACUUM
+            await conn.execute(f'PRAGMA auto_vacuum = {wanted}')
+            await conn.execute('VACUUM')
+        await conn.execute(f"PRAGMA journal_mode = {profile['journal_mode']}")
+
+async def _apply_connection_pragmas(conn: aiosqlite.Connection, profile: Dict):
+    """Настройки, которые действуют в пределах одного соединения"""
+    await conn.execute(f"PRAGMA synchronous = {profile['synchronous']}")
+    await conn.execute(f"PRAGMA mmap_size = {profile['mmap_size']}")
+    await conn.execute(f"PRAGMA cache_size = {profile['cache_size']}")
+
+
+class ConnectionPool:
+    """Пул постоянных соединений с базой данных"""
+
+    def __init__(self, path: str, size: int, profile: Dict):
+        self.path = path
+        self.size = max(1, size)
+        self.profile = profile
+        self._connections: List[aiosqlite.Connection] = []
+        self._idle: asyncio.Queue = asyncio.Queue()
+
+    async def open(self):
+        for _ in range(self.size):
+            conn = await aiosqlite.connect(self.path, timeout=30.0)
+            conn.row_factory = aiosqlite.Row
+            await _apply_connection_pragmas(conn, self.profile)
+            self._connections.append(conn)
+            self._idle.put_nowait(conn)
+
+    @asynccontextmanager
+    async def acquire(self):
+        """Взять соединение из пула (возвращается обратно после использования)"""
+        conn = await self._idle.get()
+        try:
+            yield conn
+        finally:
+            # Незавершенная транзакция не должна достаться следующему вызову
+            if conn.in_transaction:
+                await conn.rollback()
+            self._idle.put_nowait(conn)
+
+    async def close(self):
+        for conn in self._connections:
+            await conn.close()
+        self._connections.clear()
+
+
+class Writer:
+    """Единственный писатель базы данных.
+
+    Все изменения проходят через одну задачу с очередью: несколько операций,
+    накопившихся в очереди, выполняются в одной транзакции (group commit),
+    каждая под своим SAVEPOINT, так что ошибка одной операции не откатывает
+    остальные. Вызывающий получает результат своей операции через future.
+    Операция с transaction=False выполняется отдельно и сама управляет
+    транзакцией (например, чтобы выполнить ATTACH).
+
+    Когда очередь простаивает DB_MAINTENANCE_IDLE секунд после записей,
+    писатель делает checkpoint WAL и incremental vacuum.
+    """
+
+    def __init__(self, path: str, batch_size: int, profile: Dict):
+        self.path = path
+        self.batch_size = max(1, batch_size)
+        self.profile = profile
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._conn: Optional[aiosqlite.Connection] = None
+        self._task: Optional[asyncio.Task] = None
+        self._needs_maintenance = False
+
+    async def start(self):
+        # isolation_level=None: транзакциями управляем сами
+        self._conn = await aiosqlite.connect(self.path, timeout=30.0, isolation_level=None)
+        self._conn.row_factory = aiosqlite.Row
+        await _apply_connection_pragmas(self._conn, self.profile)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Дописать все, что уже в очереди, и закрыть соединение"""
+        if self._task is not None:
+            self._queue.put_nowait(None)
+            await self._task
+            self._task = None
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+
+    async def submit(self, op: Callable[[aiosqlite.Connection], Awaitable], transaction: bool = True):
+        """Поставить операцию в очередь и дождаться ее фиксации"""
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((op, future, transaction))
+        return await future
+
+    async def _run(self):
+        stopping = False
+        held = None
+        while not stopping:
+            if held is not None:
+                item, held = held, None
+            else:
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout=DB_MAINTENANCE_IDLE)
+                except asyncio.TimeoutError:
+                    if self._needs_maintenance:
+                        await self._maintenance()
+                    continue
+            if item is None:
+                break
+            self._needs_maintenance = True
+            if not item[2]:
+                await self._run_alone(item)
+                continue
+            batch = [item]
+            # Забираем все, что успело накопиться, в ту же транзакцию
+            while len(batch) < self.batch_size and not self._queue.empty():
+                item = self._queue.get_nowait()
+                if item is None:
+                    stopping = True
+                    break
+                if not item[2]:
+                    # Выполним после фиксации пакета
+                    held = item
+                    break
+                batch.append(item)
+            await self._commit_batch(batch)
+
+    async def _run_alone(self, item):
+        """Операция вне общей транзакции: транзакцией управляет она сама"""
+        op, future, _ = item
+        if future.cancelled():
+            return
+        try:
+            result = await op(self._conn)
+        except Exception as e:
+            if self._conn.in_transaction:
+                await self._conn.execute('ROLLBACK')
+            if not future.done():
+                future.set_exception(e)
+        else:
+            if not future.done():
+                future.set_result(result)
+
+    async def _maintenance(self):
+        """Checkpoint WAL и возврат свободных страниц в простое"""
+        self._needs_maintenance = False
+        try:
+            if self.profile['journal_mode'] == 'WAL':
+                # PASSIVE не ждет читателей и не блокирует их
+                await self._conn.execute('PRAGMA wal_checkpoint(PASSIVE)')
+            if self.profile['auto_vacuum'] == 'INCREMENTAL':
+                async with self._conn.execute('PRAGMA freelist_count') as cursor:
+                    free_pages = (await cursor.fetchone())[0]
+                if free_pages:
+                    # executescript прокручивает прагму до конца (execute освобождает лишь одну страницу)
+                    await self._conn.executescript(f'PRAGMA incremental_vacuum({DB_VACUUM_PAGES})')
+                    # Остаток освободим в следующий простой
+                    self._needs_maintenance = free_pages > DB_VACUUM_PAGES
+        except Exception:
+            logging.exception('Ошибка обслуживания базы данных')
+
+    async def _commit_batch(self, batch: list):
+        results = []
+        try:
+            await self._conn.execute('BEGIN IMMEDIATE')
+            for op, future, _ in batch:
+                if future.cancelled():
+                    continue
+                await self._conn.execute('SAVEPOINT op')
+                try:
+                    result = await op(self._conn)
+                except Exception as e:
+                    await self._conn.execute('ROLLBACK TO op')
+                    await self._conn.execute('RELEASE op')
+                    results.append((future, None, e))
+                else:
+                    await self._conn.execute('RELEASE op')
+                    results.append((future, result, None))
+            await self._conn.execute('COMMIT')
+        except Exception as e:
+            logging.exception('Не удалось зафиксировать пакет записей')
+            if self._conn.in_transaction:
+                await self._conn.execute('ROLLBACK')
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        # Результаты отдаем только после COMMIT
+        for future, result, error in results:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+
+_pool: Optional[ConnectionPool] = None
+_writer: Optional[Writer] = None
+
+def _connection():
+    """Соединение из общего пула (только для чтения)"""
+    if _pool is None:
+        raise RuntimeError('База данных не инициализирована: вызовите init_db()')
+    return _pool.acquire()
+
+async def _write(op: Callable[[aiosqlite.Connection], Awaitable], transaction: bool = True):
+    """Выполнить изменение через единственного писателя"""
+    if _writer is None:
+        raise RuntimeError('База данных не инициализирована: вызовите init_db()')
+    return await _writer.submit(op, transaction)
+
+async def open_db():
+    """Открыть пул соединений и запустить писателя"""
+    global _pool, _writer
+    if _pool is not None:
+        return
+    profile = _storage_profile()
+    await _configure_storage(profile)
+    pool = ConnectionPool(DB_NAME, DB_POOL_SIZE, profile)
+    writer = Writer(DB_NAME, DB_WRITE_BATCH_SIZE, profile)
+    try:
+        await pool.open()
+        await writer.start()
+    except BaseException:
+        # Потоки aiosqlite не фоновые: незакрытое соединение не даст процессу завершиться
+        await writer.stop()
+        await pool.close()
+        raise
+    _pool, _writer = pool, writer
+
+async def close_db():
+    """Закрыть все соединения (при остановке бота)"""
+    global _pool, _writer
+    if _writer is not None:
+        # Дописываем отложенные профили клиентов
+        await flush_users()
+        await _writer.stop()
+        _writer = None
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+# Миграции схемы. Номер версии хранится в PRAGMA user_version;
+# новые миграции добавляются только в конец списка MIGRATIONS.
+async def _migration_1(db):
+    """Базовая схема"""
+    # Таблица городов
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS cities (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL UNIQUE,
+            aliases TEXT
+        )
+    ''')
+    
+    # Таблица товаров (БЕЗ привязки к городу, БЕЗ иконки)
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS products (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            price REAL NOT NULL
+        )
+    ''')
+    
+    # Таблица районов
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS districts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            city_id INTEGER,
+            FOREIGN KEY (city_id) REFERENCES cities(id)
+        )
+    ''')
+    
+    # Таблица связи районов и товаров (многие ко многим)
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS district_products (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            district_id INTEGER,
+            product_id INTEGER,
+            FOREIGN KEY (district_id) REFERENCES districts(id),
+            FOREIGN KEY (product_id) REFERENCES products(id),
+            UNIQUE(district_id, product_id)
+        )
+    ''')
+    
+    # Таблица способов оплаты
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS payment_methods (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL UNIQUE,
+            code TEXT NOT NULL UNIQUE,
+            rate REAL NOT NULL,
+            address TEXT,
+            enabled INTEGER DEFAULT 1
+        )
+    ''')
+    
+    # Таблица клиентов
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            blocked INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # Таблица заявок
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS orders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_number INTEGER UNIQUE NOT NULL,
+            user_id INTEGER NOT NULL,
+            product_id INTEGER,
+            city_id INTEGER,
+            district_id INTEGER,
+            payment_method TEXT,
+            amount_rub REAL,
+            amount_currency REAL,
+            currency_code TEXT,
+            status TEXT DEFAULT 'pending',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (product_id) REFERENCES products(id),
+            FOREIGN KEY (city_id) REFERENCES cities(id),
+            FOREIGN KEY (district_id) REFERENCES districts(id),
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+    ''')
+    
+    # Таблица настроек
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    ''')
+    
+    # Иконка по умолчанию (уже выбранную не перезаписываем)
+    await db.execute('INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)', ('product_icon', '📦'))
+
+async def _migration_2(db):
+    """Индексы для запросов витрины, заявок и статистики"""
+    # get_districts_by_city, get_products_by_city, delete_city
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_districts_city ON districts(city_id)')
+    # get_products_by_city, get_districts_by_city_and_product, delete_product
+    # (поиск по district_id покрывает UNIQUE(district_id, product_id))
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_district_products_product ON district_products(product_id, district_id)')
+    # get_all_products, get_products_by_district (ORDER BY name)
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_products_name ON products(name)')
+    # get_enabled_payment_methods
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_payment_methods_enabled ON payment_methods(enabled, id)')
+    # get_pending_orders, expire_stale_orders, get_board_orders
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_orders_status_created ON orders(status, created_at)')
+    # get_order_stats за период (в _migration_7 заменен покрывающим индексом)
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_orders_created ON orders(created_at)')
+    # get_all_users (ORDER BY created_at)
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_users_created ON users(created_at)')
+
+async def _migration_3(db):
+    """Счетчик номеров заявок"""
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS order_counter (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            next_number INTEGER NOT NULL
+        )
+    ''')
+    await db.execute('''
+        INSERT OR IGNORE INTO order_counter (id, next_number)
+        SELECT 1, COALESCE(MAX(order_number) + 1, ?) FROM orders
+    ''', (INITIAL_ORDER_NUMBER,))
+
+async def _migration_4(db):
+    """Состояния FSM (диалоги клиентов и админов)"""
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL DEFAULT '{}',
+            updated_at REAL NOT NULL
+        )
+    ''')
+
+async def _migration_5(db):
+    """Журнал сбросов кэша для нескольких процессов-обработчиков"""
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS cache_invalidations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            origin TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            payload TEXT,
+            created_at REAL NOT NULL
+        )
+    ''')
+
+async def _migration_6(db):
+    """Очередь исходящих сообщений"""
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            created_at REAL NOT NULL
+        )
+    ''')
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_outbox_next_attempt ON outbox(next_attempt_at, id)')
+
+async def _migration_7(db):
+    """Покрывающий индекс для статистики заказов"""
+    # get_order_stats читает только индекс, не обращаясь к строкам заказов
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_orders_created_status_amount ON orders(created_at, status, amount_rub)')
+    # Префикс нового индекса, больше не нужен
+    await db.execute('DROP INDEX IF EXISTS idx_orders_created')
+
+async def _migration_8(db):
+    """Сводка продаж по дням, городам, районам, товарам и способам оплаты"""
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS order_rollup (
+            day TEXT NOT NULL,
+            city_id INTEGER NOT NULL,
+            district_id INTEGER NOT NULL,
+            product_id INTEGER NOT NULL,
+            payment_method TEXT NOT NULL,
+            status TEXT NOT NULL,
+            orders INTEGER NOT NULL,
+            amount REAL NOT NULL,
+            PRIMARY KEY (day, city_id, district_id, product_id, payment_method, status)
+        )
+    ''')
+    await _rebuild_rollup(db)
+
+async def _migration_9(db):
+    """Индекс для поиска более ранних сообщений в тот же чат"""
+    # get_due_messages: сообщение в чат не отправляется раньше предыдущих
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_outbox_chat ON outbox(chat_id, id)')
+
+MIGRATIONS = [
+    _migration_1,
+    _migration_2,
+    _migration_3,
+    _migration_4,
+    _migration_5,
+    _migration_6,
+    _migration_7,
+    _migration_8,
+    _migration_9,
+]
+
+async def _schema_version() -> int:
+    async with _connection() as db:
+        async with db.execute('PRAGMA user_version') as cursor:
+            return (await cursor.fetchone())[0]
+
+async def _migrate():
+    """Применить недостающие миграции"""
+    if await _schema_version() >= len(MIGRATIONS):
+        return
+
+    async def op(db):
+        async with db.execute('PRAGMA user_version') as cursor:
+            version = (await cursor.fetchone())[0]
+        for number in range(version + 1, len(MIGRATIONS) + 1):
+            await MIGRATIONS[number - 1](db)
+            await db.execute(f'PRAGMA user_version = {number}')
+        return version
+    previous = await _write(op)
+    # Другой процесс мог успеть обновить схему раньше
+    if previous < len(MIGRATIONS):
+        logging.info('Схема базы данных обновлена: версия %s -> %s', previous, len(MIGRATIONS))
+
 async def init_db():
     """Инициализация базы данных"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        # Таблица городов
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS cities (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL UNIQUE,
-                aliases TEXT
-            )
-        ''')
-        
-        # Таблица товаров (БЕЗ привязки к городу, БЕЗ иконки)
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS products (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                price REAL NOT NULL
-            )
-        ''')
-        
-        # Таблица районов
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS districts (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                city_id INTEGER,
-                FOREIGN KEY (city_id) REFERENCES cities(id)
-            )
-        ''')
-        
-        # Таблица связи районов и товаров (многие ко многим)
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS district_products (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                district_id INTEGER,
-                product_id INTEGER,
-                FOREIGN KEY (district_id) REFERENCES districts(id),
-                FOREIGN KEY (product_id) REFERENCES products(id),
-                UNIQUE(district_id, product_id)
-            )
-        ''')
-        
-        # Таблица способов оплаты
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS payment_methods (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL UNIQUE,
-                code TEXT NOT NULL UNIQUE,
-                rate REAL NOT NULL,
-                address TEXT,
-                enabled INTEGER DEFAULT 1
-            )
-        ''')
-        
-        # Таблица клиентов
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                last_name TEXT,
-                blocked INTEGER DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Таблица заявок
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS orders (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                order_number INTEGER UNIQUE NOT NULL,
-                user_id INTEGER NOT NULL,
-                product_id INTEGER,
-                city_id INTEGER,
-                district_id INTEGER,
-                payment_method TEXT,
-                amount_rub REAL,
-                amount_currency REAL,
-                currency_code TEXT,
-                status TEXT DEFAULT 'pending',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (product_id) REFERENCES products(id),
-                FOREIGN KEY (city_id) REFERENCES cities(id),
-                FOREIGN KEY (district_id) REFERENCES districts(id),
-                FOREIGN KEY (user_id) REFERENCES users(id)
-            )
-        ''')
-        
-        # Таблица настроек
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS settings (
-                key TEXT PRIMARY KEY,
-                value TEXT
-            )
-        ''')
-        
-        await db.commit()
-        
-        # Устанавливаем иконку по умолчанию
-        await set_setting('product_icon', '📦')
+    await open_db()
+    try:
+        await _migrate()
+        await _load_settings()
+        await _rebuild_city_index()
+        await _load_blocked()
+    except BaseException:
+        await close_db()
+        raise
+
+# Кэш запросов витрины. Записи помечены тегами ('city', id), ('product', id),
+# ('district', id), ('payment_methods',); изменения сбрасывают только свои теги.
+# Возвращаемые из кэша списки и словари нельзя изменять.
+_catalog_cache = CatalogCache(CATALOG_CACHE_SIZE)
+
+async def _cached(key: tuple, load: Callable[[], Awaitable], tags: Callable[[object], Iterable]):
+    """Прочитать через кэш витрины"""
+    found, value = _catalog_cache.get(key)
+    if found:
+        return value
+    generation = _catalog_cache.generation
+    value = await load()
+    _catalog_cache.put(key, value, tags(value), generation)
+    return value
+
+async def _invalidate(*tags):
+    """Сбросить теги кэша витрины (и в других процессах)"""
+    _catalog_cache.invalidate(*tags)
+    await _publish('tags', [list(tag) for tag in tags])
+
+async def _reload_catalog():
+    """Сбросить все снимки и кэши после замены каталога"""
+    _catalog_cache.clear()
+    await _load_settings()
+    await _rebuild_city_index()
+
+def get_cache_stats() -> Dict[str, int]:
+    """Счетчики попаданий и промахов кэша витрины"""
+    return _catalog_cache.stats()
+
+async def _district_city(db, district_id: int) -> Optional[int]:
+    async with db.execute('SELECT city_id FROM districts WHERE id = ?', (district_id,)) as cursor:
+        row = await cursor.fetchone()
+        return row[0] if row else None
+
+# Синхронизация кэшей между процессами
+# Когда обработчиков несколько (BOT_WORKERS > 1), у каждого свои кэш витрины,
+# снимок настроек, индекс городов, список заблокированных и отпечатки записанных
+# профилей клиентов. Каждое изменение записывается в
+# cache_invalidations, а остальные процессы раз в CACHE_SYNC_INTERVAL секунд
+# читают новые записи и сбрасывают у себя то же самое.
+_sync_enabled = False
+_sync_origin = secrets.token_hex(8)
+_sync_last_id = 0
+# Сколько секунд хранить записи журнала
+_SYNC_RETENTION = 60 * 60
+
+async def _publish(kind: str, payload=None):
+    if not _sync_enabled:
+        return
+    async def op(db):
+        await db.execute(
+            'INSERT INTO cache_invalidations (origin, kind, payload, created_at) VALUES (?, ?, ?, ?)',
+            (_sync_origin, kind, json.dumps(payload), time.time())
+        )
+        await db.execute('DELETE FROM cache_invalidations WHERE created_at < ?', (time.time() - _SYNC_RETENTION,))
+    await _write(op)
+
+async def enable_cache_sync():
+    """Включить обмен сбросами кэша с другими процессами"""
+    global _sync_enabled, _sync_last_id
+    async with _connection() as db:
+        async with db.execute('SELECT COALESCE(MAX(id), 0) FROM cache_invalidations') as cursor:
+            _sync_last_id = (await cursor.fetchone())[0]
+    _sync_enabled = True
+
+async def sync_caches() -> int:
+    """Применить сбросы кэша, сделанные другими процессами"""
+    global _sync_last_id
+    async with _connection() as db:
+        async with db.execute(
+            'SELECT id, origin, kind, payload FROM cache_invalidations WHERE id > ? ORDER BY id',
+            (_sync_last_id,)
+        ) as cursor:
+            events = [dict(row) async for row in cursor]
+    if not events:
+        return 0
+
+    tags, kinds = [], set()
+    for event in events:
+        if event['origin'] == _sync_origin:
+            continue
+        if event['kind'] == 'tags':
+            tags.extend(tuple(tag) for tag in json.loads(event['payload']))
+        else:
+            kinds.add(event['kind'])
+    _sync_last_id = events[-1]['id']
+
+    if 'catalog' in kinds:
+        # Полная перезагрузка покрывает теги, настройки и города, но не блокировки
+        await _reload_catalog()
+    else:
+        if tags:
+            _catalog_cache.invalidate(*tags)
+        if 'settings' in kinds:
+            await _load_settings()
+        if 'cities' in kinds:
+            await _rebuild_city_index()
+    if 'blocked' in kinds:
+        await _load_blocked()
+    if 'users' in kinds:
+        _user_fingerprints.clear()
+    return len(events)
+
+async def run_cache_sync(interval: float):
+    """Периодически применять сбросы кэша из других процессов"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await sync_caches()
+        except Exception:
+            logging.exception('Ошибка синхронизации кэшей')
 
 # Города
+# Индекс названий и вариантов написания для find_city
+_city_index = CityIndex()
+
+async def _rebuild_city_index():
+    _city_index.rebuild(await get_all_cities())
+
+async def _cities_changed():
+    await _rebuild_city_index()
+    await _publish('cities')
+
 async def add_city(name: str, aliases: List[str] = None):
-    async with aiosqlite.connect(DB_NAME) as db:
+    async def op(db):
         aliases_str = json.dumps(aliases) if aliases else '[]'
         await db.execute('INSERT INTO cities (name, aliases) VALUES (?, ?)', (name, aliases_str))
-        await db.commit()
+    await _write(op)
+    await _cities_changed()
 
 async def find_city(query: str) -> Optional[Dict]:
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute('SELECT * FROM cities') as cursor:
-            async for row in cursor:
-                city_name = row['name'].lower()
-                aliases = json.loads(row['aliases'])
-                query_lower = query.lower().strip()
-                
-                if query_lower == city_name or query_lower in [a.lower() for a in aliases]:
-                    return dict(row)
-    return None
+    """Найти город по названию или варианту написания (без обращения к базе)"""
+    return _city_index.find(query)
+
+async def find_similar_city(query: str) -> Optional[Dict]:
+    """Найти город, допуская опечатки в названии"""
+    return _city_index.find_similar(query)
 
 async def get_all_cities() -> List[Dict]:
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
+    async with _connection() as db:
         async with db.execute('SELECT * FROM cities') as cursor:
             return [dict(row) async for row in cursor]
 
 # Товары (БЕЗ привязки к городу, БЕЗ иконки)
 async def add_product(name: str, price: float):
-    async with aiosqlite.connect(DB_NAME) as db:
+    async def op(db):
         await db.execute('INSERT INTO products (name, price) VALUES (?, ?)', (name, price))
-        await db.commit()
+    await _write(op)
 
 async def add_products_bulk(products: List[tuple]):
     """Массовое добавление товаров [(name, price), ...]"""
-    async with aiosqlite.connect(DB_NAME) as db:
+    async def op(db):
         await db.executemany('INSERT INTO products (name, price) VALUES (?, ?)', products)
-        await db.commit()
+    await _write(op)
 
 async def get_all_products() -> List[Dict]:
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
+    async with _connection() as db:
         async with db.execute('SELECT * FROM products ORDER BY name') as cursor:
             return [dict(row) async for row in cursor]
 
 async def get_products_by_city(city_id: int) -> List[Dict]:
     """Получить все уникальные товары, доступные в городе"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute('''
-            SELECT DISTINCT p.* FROM products p
-            JOIN district_products dp ON p.id = dp.product_id
-            JOIN districts d ON dp.district_id = d.id
-            WHERE d.city_id = ?
-            ORDER BY p.name
-        ''', (city_id,)) as cursor:
-            return [dict(row) async for row in cursor]
+    async def load():
+        async with _connection() as db:
+            async with db.execute('''
+                SELECT DISTINCT p.* FROM products p
+                JOIN district_products dp ON p.id = dp.product_id
+                JOIN districts d ON dp.district_id = d.id
+                WHERE d.city_id = ?
+                ORDER BY p.name
+            ''', (city_id,)) as cursor:
+                return [dict(row) async for row in cursor]
+    return await _cached(
+        ('products_by_city', city_id), load,
+        lambda products: [('city', city_id)] + [('product', p['id']) for p in products]
+    )
 
 async def get_products_by_district(district_id: int) -> List[Dict]:
     """Получить товары доступные в конкретном районе"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
+    async with _connection() as db:
         async with db.execute('''
             SELECT p.* FROM products p
             JOIN district_products dp ON p.id = dp.product_id
@@ -178,23 +730,33 @@ async def get_products_by_district(district_id: int) -> List[Dict]:
 
 async def delete_product(product_id: int):
     """Удалить товар из общего списка и всех районов"""
-    async with aiosqlite.connect(DB_NAME) as db:
+    async def op(db):
+        # Города, где был товар (для сброса кэша)
+        async with db.execute('''
+            SELECT DISTINCT d.city_id FROM district_products dp
+            JOIN districts d ON dp.district_id = d.id
+            WHERE dp.product_id = ?
+        ''', (product_id,)) as cursor:
+            city_ids = [row[0] async for row in cursor]
         # Удаляем связи с районами
         await db.execute('DELETE FROM district_products WHERE product_id = ?', (product_id,))
         # Удаляем товар
         await db.execute('DELETE FROM products WHERE id = ?', (product_id,))
-        await db.commit()
+        return city_ids
+    city_ids = await _write(op)
+    await _invalidate(('product', product_id), *[('city', city_id) for city_id in city_ids])
 
 async def update_product_name(product_id: int, new_name: str):
     """Изменить название товара"""
-    async with aiosqlite.connect(DB_NAME) as db:
+    async def op(db):
         await db.execute('UPDATE products SET name = ? WHERE id = ?', (new_name, product_id))
-        await db.commit()
+    await _write(op)
+    await _invalidate(('product', product_id))
 
 # Районы
 async def add_district(name: str, city_id: int, product_ids: List[int]):
     """Добавить район с товарами"""
-    async with aiosqlite.connect(DB_NAME) as db:
+    async def op(db):
         cursor = await db.execute('INSERT INTO districts (name, city_id) VALUES (?, ?)', (name, city_id))
         district_id = cursor.lastrowid
         
@@ -203,78 +765,194 @@ async def add_district(name: str, city_id: int, product_ids: List[int]):
             await db.execute('INSERT INTO district_products (district_id, product_id) VALUES (?, ?)',
                            (district_id, product_id))
         
-        await db.commit()
         return district_id
+    district_id = await _write(op)
+    await _invalidate(('city', city_id))
+    return district_id
 
 async def get_districts_by_city(city_id: int) -> List[Dict]:
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
+    async with _connection() as db:
         async with db.execute('SELECT * FROM districts WHERE city_id = ?', (city_id,)) as cursor:
             return [dict(row) async for row in cursor]
 
 async def get_districts_by_city_and_product(city_id: int, product_id: int) -> List[Dict]:
     """Получить районы города, где доступен конкретный товар"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute('''
-            SELECT DISTINCT d.* FROM districts d
-            JOIN district_products dp ON d.id = dp.district_id
-            WHERE d.city_id = ? AND dp.product_id = ?
-        ''', (city_id, product_id)) as cursor:
-            return [dict(row) async for row in cursor]
+    async def load():
+        async with _connection() as db:
+            async with db.execute('''
+                SELECT DISTINCT d.* FROM districts d
+                JOIN district_products dp ON d.id = dp.district_id
+                WHERE d.city_id = ? AND dp.product_id = ?
+            ''', (city_id, product_id)) as cursor:
+                return [dict(row) async for row in cursor]
+    return await _cached(('districts_by_city_and_product', city_id, product_id), load,
+                         lambda districts: [('city', city_id)])
 
 # Заявки
 async def create_order(user_id: int, product_id: int, city_id: int, district_id: int, 
                       payment_method: str, amount_rub: float, amount_currency: float, currency_code: str) -> int:
-    async with aiosqlite.connect(DB_NAME) as db:
-        # Получаем последний номер заявки
-        async with db.execute('SELECT MAX(order_number) as max_num FROM orders') as cursor:
-            row = await cursor.fetchone()
-            from config import INITIAL_ORDER_NUMBER
-            next_number = (row[0] + 1) if row[0] else INITIAL_ORDER_NUMBER
+    async def op(db):
+        # Берем номер из счетчика в той же транзакции, что и вставка заявки:
+        # при ошибке вставки откатится и счетчик, так что пропусков не будет
+        async with db.execute(
+            'UPDATE order_counter SET next_number = next_number + 1 WHERE id = 1 RETURNING next_number - 1'
+        ) as cursor:
+            next_number = (await cursor.fetchone())[0]
         
-        await db.execute('''
+        async with db.execute(f'''
             INSERT INTO orders (order_number, user_id, product_id, city_id, district_id, 
                               payment_method, amount_rub, amount_currency, currency_code)
             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            RETURNING NULL AS status, amount_rub, {_ROLLUP_KEY}
         ''', (next_number, user_id, product_id, city_id, district_id, 
-              payment_method, amount_rub, amount_currency, currency_code))
-        await db.commit()
+              payment_method, amount_rub, amount_currency, currency_code)) as cursor:
+            created = [dict(row) for row in await cursor.fetchall()]
+        await _update_rollup(db, created, 'pending')
         return next_number
+    return await _write(op)
 
 async def get_order_by_number(order_number: int) -> Optional[Dict]:
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
+    async with _connection() as db:
         async with db.execute('SELECT * FROM orders WHERE order_number = ?', (order_number,)) as cursor:
             row = await cursor.fetchone()
             return dict(row) if row else None
 
+def _shard_filter(shard: Optional[tuple], column: str = 'user_id') -> tuple:
+    """Условие на строки клиентов одного обработчика: shard = (номер, всего)"""
+    if shard is None:
+        return '', ()
+    index, count = shard
+    return f' AND abs({column}) % ? = ?', (count, index)
+
+async def get_pending_orders(shard: Optional[tuple] = None) -> List[Dict]:
+    """Неоплаченные заявки (для восстановления таймеров оплаты)"""
+    condition, params = _shard_filter(shard)
+    async with _connection() as db:
+        async with db.execute(
+            "SELECT order_number, user_id, created_at FROM orders WHERE status = 'pending'" + condition,
+            params
+        ) as cursor:
+            return [dict(row) async for row in cursor]
+
+async def expire_stale_orders(timeout: int, shard: Optional[tuple] = None,
+                              notification: Optional[str] = None) -> List[Dict]:
+    """Отменить одним запросом все заявки, ожидающие оплаты дольше timeout секунд.
+
+    Если задан notification, уведомления клиентам ставятся в очередь исходящих
+    сообщений в той же транзакции.
+    """
+    condition, params = _shard_filter(shard)
+    async def op(db):
+        async with db.execute(f'''
+            UPDATE orders SET status = 'cancelled'
+            WHERE status = 'pending' AND created_at <= datetime('now', ?){condition}
+            RETURNING order_number, user_id, 'pending' AS status, amount_rub, {_ROLLUP_KEY}
+        ''', (f'-{int(timeout)} seconds', *params)) as cursor:
+            expired = [dict(row) async for row in cursor]
+        await _update_rollup(db, expired, 'cancelled')
+        if notification:
+            await _enqueue(db, [(order['user_id'], notification) for order in expired])
+        return expired
+    return await _write(op)
+
+async def _set_order_status(order_number: int, status: str):
+    async def op(db):
+        async with db.execute(
+            f'SELECT status, amount_rub, {_ROLLUP_KEY} FROM orders WHERE order_number = ? AND status != ?',
+            (order_number, status)
+        ) as cursor:
+            orders = [dict(row) for row in await cursor.fetchall()]
+        if orders:
+            await db.execute('UPDATE orders SET status = ? WHERE order_number = ?', (status, order_number))
+            await _update_rollup(db, orders, status)
+    await _write(op)
+
 async def cancel_order(order_number: int):
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute('UPDATE orders SET status = ? WHERE order_number = ?', ('cancelled', order_number))
-        await db.commit()
+    await _set_order_status(order_number, 'cancelled')
 
 async def complete_order(order_number: int):
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute('UPDATE orders SET status = ? WHERE order_number = ?', ('paid', order_number))
-        await db.commit()
+    await _set_order_status(order_number, 'paid')
+
+# Сводка продаж: строка на (день, город, район, товар, способ оплаты, статус)
+# с количеством и суммой заявок. Обновляется в тех же транзакциях, что и заявки.
+# День считается по местному времени сервера, как и периоды в /stats.
+# Заявки без created_at (из импорта старых версий) попадают в день '' -
+# они учитываются только в разбивке за все время.
+_ROLLUP_KEY = '''COALESCE(date(created_at, 'localtime'), '') AS day, COALESCE(city_id, 0) AS city_id,
+    COALESCE(district_id, 0) AS district_id, COALESCE(product_id, 0) AS product_id,
+    COALESCE(payment_method, '') AS payment_method'''
+
+async def _update_rollup(db, orders: List[Dict], status: str):
+    """Перенести заявки в сводке из их прежнего статуса (None - новая заявка) в status"""
+    changes: Dict[tuple, list] = {}
+    for order in orders:
+        key = (order['day'], order['city_id'], order['district_id'], order['product_id'], order['payment_method'])
+        amount = order['amount_rub'] or 0
+        moves = [(status, 1)] if order['status'] is None else [(order['status'], -1), (status, 1)]
+        for row_status, sign in moves:
+            change = changes.setdefault((*key, row_status), [0, 0])
+            change[0] += sign
+            change[1] += sign * amount
+    if changes:
+        await db.executemany('''
+            INSERT INTO order_rollup (day, city_id, district_id, product_id, payment_method, status, orders, amount)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (day, city_id, district_id, product_id, payment_method, status) DO UPDATE SET
+                orders = orders + excluded.orders,
+                amount = amount + excluded.amount
+        ''', [(*key, count, amount) for key, (count, amount) in changes.items()])
+
+async def _rebuild_rollup(db):
+    """Пересчитать сводку целиком по таблице заявок"""
+    await db.execute('DELETE FROM order_rollup')
+    await db.execute(f'''
+        INSERT INTO order_rollup (day, city_id, district_id, product_id, payment_method, status, orders, amount)
+        SELECT day, city_id, district_id, product_id, payment_method, status, COUNT(*), COALESCE(SUM(amount_rub), 0)
+        FROM (SELECT {_ROLLUP_KEY}, status, amount_rub FROM orders WHERE status IS NOT NULL)
+        GROUP BY day, city_id, district_id, product_id, payment_method, status
+    ''')
+
+async def get_board_orders(paid_window_hours: int) -> List[Dict]:
+    """Ожидающие оплаты заявки и оплаченные за последние часы (для доски заявок)"""
+    async with _connection() as db:
+        async with db.execute('''
+            SELECT o.order_number, o.status, o.amount_currency, o.currency_code, o.created_at, p.name AS product_name
+            FROM orders o LEFT JOIN products p ON p.id = o.product_id
+            WHERE o.status = 'pending'
+            UNION ALL
+            SELECT o.order_number, o.status, o.amount_currency, o.currency_code, o.created_at, p.name AS product_name
+            FROM orders o LEFT JOIN products p ON p.id = o.product_id
+            WHERE o.status = 'paid' AND o.created_at >= datetime('now', ?)
+            ORDER BY order_number DESC
+        ''', (f'-{int(paid_window_hours)} hours',)) as cursor:
+            return [dict(row) async for row in cursor]
 
 # Настройки
+# Снимок таблицы settings: чтение настроек не обращается к базе.
+# Снимок не изменяется на месте, а целиком заменяется новым словарем.
+_settings: Dict[str, str] = {}
+
+async def _load_settings():
+    global _settings
+    async with _connection() as db:
+        async with db.execute('SELECT key, value FROM settings') as cursor:
+            _settings = {row['key']: row['value'] async for row in cursor}
+
 async def set_setting(key: str, value: str):
-    async with aiosqlite.connect(DB_NAME) as db:
+    global _settings
+    async def op(db):
         await db.execute('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', (key, value))
-        await db.commit()
+    await _write(op)
+    _settings = {**_settings, key: value}
+    await _publish('settings')
 
 async def get_setting(key: str, default: str = '') -> str:
-    async with aiosqlite.connect(DB_NAME) as db:
-        async with db.execute('SELECT value FROM settings WHERE key = ?', (key,)) as cursor:
-            row = await cursor.fetchone()
-            return row[0] if row else default
+    return _settings.get(key, default)
 
 # Удаление и редактирование
 async def delete_city(city_id: int):
     """Удалить город со всеми районами и связями товаров"""
-    async with aiosqlite.connect(DB_NAME) as db:
+    async def op(db):
         # Получаем все районы города
         async with db.execute('SELECT id FROM districts WHERE city_id = ?', (city_id,)) as cursor:
             district_ids = [row[0] async for row in cursor]
@@ -288,30 +966,37 @@ async def delete_city(city_id: int):
         
         # Удаляем город
         await db.execute('DELETE FROM cities WHERE id = ?', (city_id,))
-        
-        await db.commit()
+        return district_ids
+    district_ids = await _write(op)
+    await _invalidate(('city', city_id), *[('district', district_id) for district_id in district_ids])
+    await _cities_changed()
 
 async def delete_district(district_id: int):
     """Удалить район со всеми связями товаров"""
-    async with aiosqlite.connect(DB_NAME) as db:
+    async def op(db):
+        city_id = await _district_city(db, district_id)
+        
         # Удаляем связи товаров
         await db.execute('DELETE FROM district_products WHERE district_id = ?', (district_id,))
         
         # Удаляем район
         await db.execute('DELETE FROM districts WHERE id = ?', (district_id,))
-        
-        await db.commit()
+        return city_id
+    city_id = await _write(op)
+    await _invalidate(('city', city_id), ('district', district_id))
 
 async def delete_product_from_district(district_id: int, product_id: int):
     """Удалить товар из района"""
-    async with aiosqlite.connect(DB_NAME) as db:
+    async def op(db):
         await db.execute('DELETE FROM district_products WHERE district_id = ? AND product_id = ?',
                         (district_id, product_id))
-        await db.commit()
+        return await _district_city(db, district_id)
+    city_id = await _write(op)
+    await _invalidate(('city', city_id))
 
 async def add_product_to_district(district_id: int, product_id: int):
     """Добавить товар в район"""
-    async with aiosqlite.connect(DB_NAME) as db:
+    async def op(db):
         # Проверяем, нет ли уже этого товара в районе
         async with db.execute(
             'SELECT * FROM district_products WHERE district_id = ? AND product_id = ?',
@@ -319,40 +1004,45 @@ async def add_product_to_district(district_id: int, product_id: int):
         ) as cursor:
             existing = await cursor.fetchone()
             if existing:
-                return False  # Товар уже есть
+                return False, None  # Товар уже есть
         
         # Добавляем товар
         await db.execute('INSERT INTO district_products (district_id, product_id) VALUES (?, ?)',
                         (district_id, product_id))
-        await db.commit()
-        return True  # Товар добавлен
+        return True, await _district_city(db, district_id)  # Товар добавлен
+    added, city_id = await _write(op)
+    if added:
+        await _invalidate(('city', city_id))
+    return added
 
 async def update_product_price(product_id: int, new_price: float):
     """Изменить цену товара"""
-    async with aiosqlite.connect(DB_NAME) as db:
+    async def op(db):
         await db.execute('UPDATE products SET price = ? WHERE id = ?', (new_price, product_id))
-        await db.commit()
+    await _write(op)
+    await _invalidate(('product', product_id))
 
 async def get_product_by_id(product_id: int) -> Optional[Dict]:
     """Получить товар по ID"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute('SELECT * FROM products WHERE id = ?', (product_id,)) as cursor:
-            row = await cursor.fetchone()
-            return dict(row) if row else None
+    async def load():
+        async with _connection() as db:
+            async with db.execute('SELECT * FROM products WHERE id = ?', (product_id,)) as cursor:
+                row = await cursor.fetchone()
+                return dict(row) if row else None
+    return await _cached(('product', product_id), load, lambda product: [('product', product_id)])
 
 async def get_district_by_id(district_id: int) -> Optional[Dict]:
     """Получить район по ID"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute('SELECT * FROM districts WHERE id = ?', (district_id,)) as cursor:
-            row = await cursor.fetchone()
-            return dict(row) if row else None
+    async def load():
+        async with _connection() as db:
+            async with db.execute('SELECT * FROM districts WHERE id = ?', (district_id,)) as cursor:
+                row = await cursor.fetchone()
+                return dict(row) if row else None
+    return await _cached(('district', district_id), load, lambda district: [('district', district_id)])
 
 async def get_city_by_id(city_id: int) -> Optional[Dict]:
     """Получить город по ID"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
+    async with _connection() as db:
         async with db.execute('SELECT * FROM cities WHERE id = ?', (city_id,)) as cursor:
             row = await cursor.fetchone()
             return dict(row) if row else None
@@ -361,266 +1051,667 @@ async def get_city_by_id(city_id: int) -> Optional[Dict]:
 # Способы оплаты
 async def add_payment_method(name: str, code: str, rate: float, address: str = ''):
     """Добавить способ оплаты"""
-    async with aiosqlite.connect(DB_NAME) as db:
+    async def op(db):
         await db.execute(
             'INSERT INTO payment_methods (name, code, rate, address) VALUES (?, ?, ?, ?)',
             (name, code, rate, address)
         )
-        await db.commit()
+    await _write(op)
+    await _invalidate(('payment_methods',))
 
 async def get_all_payment_methods() -> List[Dict]:
     """Получить все способы оплаты"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
+    async with _connection() as db:
         async with db.execute('SELECT * FROM payment_methods ORDER BY id') as cursor:
             return [dict(row) async for row in cursor]
 
 async def get_enabled_payment_methods() -> List[Dict]:
     """Получить активные способы оплаты"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute('SELECT * FROM payment_methods WHERE enabled = 1 ORDER BY id') as cursor:
-            return [dict(row) async for row in cursor]
+    async def load():
+        async with _connection() as db:
+            async with db.execute('SELECT * FROM payment_methods WHERE enabled = 1 ORDER BY id') as cursor:
+                return [dict(row) async for row in cursor]
+    return await _cached(('enabled_payment_methods',), load, lambda methods: [('payment_methods',)])
 
 async def get_payment_method_by_code(code: str) -> Optional[Dict]:
     """Получить способ оплаты по коду"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute('SELECT * FROM payment_methods WHERE code = ?', (code,)) as cursor:
-            row = await cursor.fetchone()
-            return dict(row) if row else None
+    async def load():
+        async with _connection() as db:
+            async with db.execute('SELECT * FROM payment_methods WHERE code = ?', (code,)) as cursor:
+                row = await cursor.fetchone()
+                return dict(row) if row else None
+    return await _cached(('payment_method', code), load, lambda method: [('payment_methods',)])
 
 async def update_payment_method_rate(code: str, new_rate: float):
     """Обновить курс способа оплаты"""
-    async with aiosqlite.connect(DB_NAME) as db:
+    async def op(db):
         await db.execute('UPDATE payment_methods SET rate = ? WHERE code = ?', (new_rate, code))
-        await db.commit()
+    await _write(op)
+    await _invalidate(('payment_methods',))
 
 async def update_payment_method_address(code: str, new_address: str):
     """Обновить адрес/номер способа оплаты"""
-    async with aiosqlite.connect(DB_NAME) as db:
+    async def op(db):
         await db.execute('UPDATE payment_methods SET address = ? WHERE code = ?', (new_address, code))
-        await db.commit()
+    await _write(op)
+    await _invalidate(('payment_methods',))
 
 async def delete_payment_method(code: str):
     """Удалить способ оплаты"""
-    async with aiosqlite.connect(DB_NAME) as db:
+    async def op(db):
         await db.execute('DELETE FROM payment_methods WHERE code = ?', (code,))
-        await db.commit()
+    await _write(op)
+    await _invalidate(('payment_methods',))
 
 async def toggle_payment_method(code: str):
     """Включить/выключить способ оплаты"""
-    async with aiosqlite.connect(DB_NAME) as db:
+    async def op(db):
         await db.execute('UPDATE payment_methods SET enabled = 1 - enabled WHERE code = ?', (code,))
-        await db.commit()
+    await _write(op)
+    await _invalidate(('payment_methods',))
 
 # Клиенты
+# Профили клиентов записываются отложенно: add_or_update_user только кладет
+# профиль в буфер, а flush_users записывает весь буфер одним executemany
+# (раз в USER_FLUSH_INTERVAL секунд или когда набралось USER_FLUSH_BATCH).
+# Профиль, который не менялся с последней записи, не записывается вовсе.
+# Буфер у каждого обработчика свой: при BOT_WORKERS > 1 список клиентов и экспорт
+# могут не включать профили из других обработчиков за последние USER_FLUSH_INTERVAL секунд.
+_user_fingerprints: Dict[int, tuple] = {}
+_pending_users: Dict[int, tuple] = {}
+
 async def add_or_update_user(user_id: int, username: str = None, first_name: str = None, last_name: str = None):
     """Добавить или обновить пользователя"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute('''
+    fingerprint = (username, first_name, last_name)
+    if _user_fingerprints.get(user_id) == fingerprint:
+        return
+    _pending_users[user_id] = fingerprint
+    _user_fingerprints[user_id] = fingerprint
+    if len(_user_fingerprints) > USER_FINGERPRINT_CACHE_SIZE:
+        # Забываем половину самых старых записей (словарь хранит порядок добавления)
+        for key in list(islice(_user_fingerprints, len(_user_fingerprints) // 2)):
+            del _user_fingerprints[key]
+    if len(_pending_users) >= USER_FLUSH_BATCH:
+        await flush_users()
+
+async def flush_users():
+    """Записать отложенные профили клиентов"""
+    global _pending_users
+    if not _pending_users:
+        return
+    pending, _pending_users = _pending_users, {}
+    async def op(db):
+        await db.executemany('''
             INSERT INTO users (id, username, first_name, last_name) 
             VALUES (?, ?, ?, ?)
             ON CONFLICT(id) DO UPDATE SET
                 username = excluded.username,
                 first_name = excluded.first_name,
                 last_name = excluded.last_name
-        ''', (user_id, username, first_name, last_name))
-        await db.commit()
+        ''', [(user_id, *fingerprint) for user_id, fingerprint in pending.items()])
+    try:
+        await _write(op)
+    except Exception:
+        # Вернуть в буфер, не затирая более свежие профили
+        _pending_users = {**pending, **_pending_users}
+        raise
+
+async def run_user_flush(interval: float):
+    """Периодически записывать отложенные профили клиентов"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await flush_users()
+        except Exception:
+            logging.exception('Не удалось записать профили клиентов')
 
 async def get_all_users() -> List[Dict]:
     """Получить всех пользователей"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
+    await flush_users()
+    async with _connection() as db:
         async with db.execute('SELECT * FROM users ORDER BY created_at DESC') as cursor:
             return [dict(row) async for row in cursor]
 
+# Заблокированные клиенты: множество в памяти, чтобы проверять каждое обновление
+# без обращения к базе. Изменяется только вместе с таблицей users.
+_blocked: Set[int] = set()
+
+async def _load_blocked():
+    global _blocked
+    async with _connection() as db:
+        async with db.execute('SELECT id FROM users WHERE blocked = 1') as cursor:
+            _blocked = {row[0] async for row in cursor}
+
 async def block_user(user_id: int):
     """Заблокировать пользователя"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute('UPDATE users SET blocked = 1 WHERE id = ?', (user_id,))
-        await db.commit()
+    # Профиль клиента может еще лежать в буфере другого обработчика: строка создается
+    # здесь, а имя допишется при сбросе буфера (blocked он не трогает)
+    async def op(db):
+        await db.execute('''
+            INSERT INTO users (id, blocked) VALUES (?, 1)
+            ON CONFLICT(id) DO UPDATE SET blocked = 1
+        ''', (user_id,))
+    await _write(op)
+    _blocked.add(user_id)
+    await _publish('blocked')
 
 async def unblock_user(user_id: int):
     """Разблокировать пользователя"""
-    async with aiosqlite.connect(DB_NAME) as db:
+    async def op(db):
         await db.execute('UPDATE users SET blocked = 0 WHERE id = ?', (user_id,))
-        await db.commit()
+    await _write(op)
+    _blocked.discard(user_id)
+    await _publish('blocked')
 
-async def is_user_blocked(user_id: int) -> bool:
-    """Проверить, заблокирован ли пользователь"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        async with db.execute('SELECT blocked FROM users WHERE id = ?', (user_id,)) as cursor:
-            row = await cursor.fetchone()
-            return bool(row[0]) if row else False
+def is_blocked(user_id: int) -> bool:
+    """Заблокирован ли пользователь (без обращения к базе)"""
+    return user_id in _blocked
 
 # Статистика
-async def get_orders_count(start_date: str = None, end_date: str = None) -> int:
-    """Получить количество заказов за период"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        if start_date and end_date:
-            async with db.execute(
-                'SELECT COUNT(*) FROM orders WHERE created_at BETWEEN ? AND ?',
-                (start_date, end_date)
-            ) as cursor:
-                row = await cursor.fetchone()
-                return row[0]
-        else:
-            async with db.execute('SELECT COUNT(*) FROM orders') as cursor:
-                row = await cursor.fetchone()
-                return row[0]
-
-async def get_orders_by_status(status: str, start_date: str = None, end_date: str = None) -> List[Dict]:
-    """Получить заказы по статусу за период"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
-        if start_date and end_date:
-            async with db.execute(
-                'SELECT * FROM orders WHERE status = ? AND created_at BETWEEN ? AND ? ORDER BY created_at DESC',
-                (status, start_date, end_date)
-            ) as cursor:
-                return [dict(row) async for row in cursor]
-        else:
-            async with db.execute('SELECT * FROM orders WHERE status = ? ORDER BY created_at DESC', (status,)) as cursor:
-                return [dict(row) async for row in cursor]
+async def get_order_stats(start_date: str = None, end_date: str = None) -> Dict[str, Dict]:
+    """Количество заказов и сумма по статусам за период: {status: {'count', 'amount'}}"""
+    query = 'SELECT status, COUNT(*), COALESCE(SUM(amount_rub), 0) FROM orders'
+    params = ()
+    if start_date and end_date:
+        query += ' WHERE created_at BETWEEN ? AND ?'
+        params = (start_date, end_date)
+    query += ' GROUP BY status'
+    async with _connection() as db:
+        async with db.execute(query, params) as cursor:
+            return {status: {'count': count, 'amount': amount} async for status, count, amount in cursor}
+
+# Разрезы сводки: колонка группировки, присоединяемые справочники и подпись
+_BREAKDOWNS = {
+    'city': ('r.city_id', 'LEFT JOIN cities c ON c.id = r.city_id', 'c.name'),
+    'district': ('r.district_id',
+                 'LEFT JOIN districts d ON d.id = r.district_id LEFT JOIN cities c ON c.id = d.city_id',
+                 "c.name || ', ' || d.name"),
+    'product': ('r.product_id', 'LEFT JOIN products p ON p.id = r.product_id', 'p.name'),
+    'payment': ('r.payment_method', 'LEFT JOIN payment_methods m ON m.code = r.payment_method', 'm.name'),
+}
+
+async def get_sales_breakdown(dimension: str, since_day: str = None, limit: int = 30) -> List[Dict]:
+    """Заявки и выручка в разрезе dimension (city, district, product, payment) из сводки продаж.
+
+    since_day - первый день периода (YYYY-MM-DD, местное время), None - за все время.
+    """
+    column, joins, label = _BREAKDOWNS[dimension]
+    condition, params = ('WHERE r.day >= ?', (since_day,)) if since_day else ('', ())
+    async with _connection() as db:
+        async with db.execute(f'''
+            SELECT COALESCE({label}, {column}) AS name,
+                   SUM(r.orders) AS total,
+                   SUM(CASE WHEN r.status = 'paid' THEN r.orders ELSE 0 END) AS paid,
+                   SUM(CASE WHEN r.status = 'cancelled' THEN r.orders ELSE 0 END) AS cancelled,
+                   SUM(CASE WHEN r.status = 'paid' THEN r.amount ELSE 0 END) AS revenue
+            FROM order_rollup r {joins}
+            {condition}
+            GROUP BY {column}
+            HAVING total > 0
+            ORDER BY revenue DESC, total DESC
+            LIMIT ?
+        ''', (*params, limit)) as cursor:
+            return [dict(row) async for row in cursor]
 
 # Экспорт/Импорт
-async def export_catalog() -> Dict:
-    """Экспорт витрины (товары, города, районы, связи)"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
-        
-        # Товары
-        async with db.execute('SELECT * FROM products') as cursor:
-            products = [dict(row) async for row in cursor]
-        
-        # Города
-        async with db.execute('SELECT * FROM cities') as cursor:
-            cities = [dict(row) async for row in cursor]
-        
-        # Районы
-        async with db.execute('SELECT * FROM districts') as cursor:
-            districts = [dict(row) async for row in cursor]
-        
-        # Связи товаров и районов
-        async with db.execute('SELECT * FROM district_products') as cursor:
-            district_products = [dict(row) async for row in cursor]
-        
-        # Способы оплаты
-        async with db.execute('SELECT * FROM payment_methods') as cursor:
-            payment_methods = [dict(row) async for row in cursor]
-        
-        # Иконка товаров
-        product_icon = await get_setting('product_icon', '📦')
-        
-        return {
-            'products': products,
-            'cities': cities,
-            'districts': districts,
-            'district_products': district_products,
-            'payment_methods': payment_methods,
-            'product_icon': product_icon
-        }
+# Экспорт в NDJSON, сжатый gzip: первая строка - заголовок
+# {"format": EXPORT_FORMAT, "version": EXPORT_VERSION, "kind": "catalog" | "data"},
+# дальше по строке на запись: {"table": ..., "row": {...}}
+EXPORT_FORMAT = 'shop-bot-export'
+EXPORT_VERSION = 1
+_EXPORT_TABLES = {
+    'catalog': ['products', 'cities', 'districts', 'district_products', 'payment_methods'],
+    'data': ['users', 'orders'],
+}
+# Настройки, которые переносятся вместе с витриной
+_EXPORT_SETTINGS = {'catalog': ['product_icon'], 'data': []}
 
-async def import_catalog(data: Dict):
-    """Импорт витрины"""
-    async with aiosqlite.connect(DB_NAME, timeout=30.0) as db:
-        # Очищаем старые данные
-        await db.execute('DELETE FROM district_products')
-        await db.execute('DELETE FROM districts')
-        await db.execute('DELETE FROM cities')
-        await db.execute('DELETE FROM products')
-        await db.execute('DELETE FROM payment_methods')
-        await db.commit()
-        
-        # Импортируем товары
-        for product in data.get('products', []):
-            await db.execute(
-                'INSERT INTO products (id, name, price) VALUES (?, ?, ?)',
-                (product['id'], product['name'], product['price'])
-            )
-        await db.commit()
-        
-        # Импортируем города
-        for city in data.get('cities', []):
-            await db.execute(
-                'INSERT INTO cities (id, name, aliases) VALUES (?, ?, ?)',
-                (city['id'], city['name'], city['aliases'])
-            )
-        await db.commit()
-        
-        # Импортируем районы
-        for district in data.get('districts', []):
-            await db.execute(
-                'INSERT INTO districts (id, name, city_id) VALUES (?, ?, ?)',
-                (district['id'], district['name'], district['city_id'])
-            )
-        await db.commit()
-        
-        # Импортируем связи
-        for dp in data.get('district_products', []):
-            await db.execute(
-                'INSERT INTO district_products (id, district_id, product_id) VALUES (?, ?, ?)',
-                (dp['id'], dp['district_id'], dp['product_id'])
-            )
-        await db.commit()
-        
-        # Импортируем способы оплаты
-        for pm in data.get('payment_methods', []):
-            await db.execute(
-                'INSERT INTO payment_methods (id, name, code, rate, address, enabled) VALUES (?, ?, ?, ?, ?, ?)',
-                (pm['id'], pm['name'], pm['code'], pm['rate'], pm.get('address', ''), pm.get('enabled', 1))
+def _export_lines(conn: sqlite3.Connection, kind: str):
+    """Строки экспорта по одной: курсор читает таблицы порциями, а не целиком"""
+    yield json.dumps({'format': EXPORT_FORMAT, 'version': EXPORT_VERSION, 'kind': kind}) + '\n'
+    for table in _EXPORT_TABLES[kind]:
+        cursor = conn.execute(f'SELECT * FROM {table}')
+        columns = [column[0] for column in cursor.description]
+        for values in cursor:
+            yield json.dumps({'table': table, 'row': dict(zip(columns, values))}, ensure_ascii=False) + '\n'
+    for key in _EXPORT_SETTINGS[kind]:
+        for key, value in conn.execute('SELECT key, value FROM settings WHERE key = ?', (key,)):
+            yield json.dumps({'table': 'settings', 'row': {'key': key, 'value': value}}, ensure_ascii=False) + '\n'
+
+def _write_export(kind: str, path: str):
+    """Записать экспорт в файл (выполняется в отдельном потоке)"""
+    conn = sqlite3.connect(f'file:{DB_NAME}?mode=ro', uri=True, timeout=30.0, isolation_level=None)
+    try:
+        # Все таблицы читаются из одного снимка базы
+        conn.execute('BEGIN')
+        with gzip.open(path, 'wt', encoding='utf-8') as f:
+            f.writelines(_export_lines(conn, kind))
+    finally:
+        conn.close()
+
+async def export_catalog(path: str):
+    """Экспорт витрины (товары, города, районы, связи, способы оплаты) в path"""
+    await asyncio.to_thread(_write_export, 'catalog', path)
+
+async def export_data(path: str):
+    """Экспорт данных (клиенты, заказы) в path"""
+    await flush_users()
+    await asyncio.to_thread(_write_export, 'data', path)
+
+# Импорт. Значения колонок по умолчанию; _REQUIRED - колонка обязательна.
+# Таблицы вставляются в порядке _EXPORT_TABLES, настройки - только из _EXPORT_SETTINGS.
+_REQUIRED = object()
+_IMPORT_COLUMNS = {
+    'products': {'id': _REQUIRED, 'name': _REQUIRED, 'price': _REQUIRED},
+    'cities': {'id': _REQUIRED, 'name': _REQUIRED, 'aliases': _REQUIRED},
+    'districts': {'id': _REQUIRED, 'name': _REQUIRED, 'city_id': _REQUIRED},
+    'district_products': {'id': _REQUIRED, 'district_id': _REQUIRED, 'product_id': _REQUIRED},
+    'payment_methods': {'id': _REQUIRED, 'name': _REQUIRED, 'code': _REQUIRED, 'rate': _REQUIRED,
+                        'address': '', 'enabled': 1},
+    'users': {'id': _REQUIRED, 'username': None, 'first_name': None, 'last_name': None,
+              'blocked': 0, 'created_at': None},
+    'orders': {'id': _REQUIRED, 'order_number': _REQUIRED, 'user_id': _REQUIRED, 'product_id': None,
+               'city_id': None, 'district_id': None, 'payment_method': None, 'amount_rub': None,
+               'amount_currency': None, 'currency_code': None, 'status': 'pending', 'created_at': None},
+    'settings': {'key': _REQUIRED, 'value': _REQUIRED},
+}
+
+def _json_records(data: Dict, kind: str):
+    """Записи (таблица, строка) из JSON-экспорта старых версий бота"""
+    for table in _EXPORT_TABLES[kind]:
+        for row in data.get(table, []):
+            yield table, row
+    for key in _EXPORT_SETTINGS[kind]:
+        if key in data:
+            yield 'settings', {'key': key, 'value': data[key]}
+
+def _ndjson_records(f):
+    """Записи (таблица, строка) из NDJSON-экспорта, по одной строке файла"""
+    try:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                yield record['table'], record['row']
+    finally:
+        f.close()
+
+def open_import(path: str) -> tuple:
+    """Определить тип файла экспорта: (kind, записи) или (None, None) для чужого файла.
+
+    NDJSON.gz читается по мере импорта; старый JSON-экспорт загружается целиком.
+    """
+    with open(path, 'rb') as f:
+        compressed = f.read(2) == b'\x1f\x8b'
+    if compressed:
+        f = gzip.open(path, 'rt', encoding='utf-8')
+        try:
+            header = json.loads(f.readline())
+        except ValueError:
+            f.close()
+            return None, None
+        if header.get('format') != EXPORT_FORMAT or header.get('kind') not in _EXPORT_TABLES:
+            f.close()
+            return None, None
+        return header['kind'], _ndjson_records(f)
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    if 'products' in data and 'cities' in data:
+        return 'catalog', _json_records(data, 'catalog')
+    if 'users' in data and 'orders' in data:
+        return 'data', _json_records(data, 'data')
+    return None, None
+
+def _import_batches(records: Iterable, kind: str, batch_size: int):
+    """Пачки (таблица, [значения]) не больше batch_size строк одной таблицы"""
+    tables = set(_EXPORT_TABLES[kind])
+    table, rows = None, []
+    for record_table, row in records:
+        if record_table == 'settings':
+            if row.get('key') not in _EXPORT_SETTINGS[kind]:
+                continue
+        elif record_table not in tables:
+            raise ValueError(f'Неизвестная таблица в файле: {record_table}')
+        if record_table != table or len(rows) >= batch_size:
+            if rows:
+                yield table, rows
+            table, rows = record_table, []
+        rows.append(tuple(
+            row[column] if default is _REQUIRED else row.get(column, default)
+            for column, default in _IMPORT_COLUMNS[record_table].items()
+        ))
+    if rows:
+        yield table, rows
+
+async def _import_records(db, records: Iterable, kind: str, progress: Optional[Callable[[int], None]]) -> int:
+    """Заменить таблицы kind записями из records (внутри операции писателя)"""
+    for table in reversed(_EXPORT_TABLES[kind]):
+        await db.execute(f'DELETE FROM {table}')
+    batches = _import_batches(records, kind, IMPORT_BATCH_SIZE)
+    imported = 0
+    while True:
+        # Чтение и разбор файла - в отдельном потоке, цикл событий не блокируется
+        batch = await asyncio.to_thread(next, batches, None)
+        if batch is None:
+            break
+        table, rows = batch
+        await db.executemany(_insert_sql(table), rows)
+        imported += len(rows)
+        if progress:
+            progress(imported)
+    return imported
+
+def _insert_sql(table: str) -> str:
+    columns = _IMPORT_COLUMNS[table]
+    verb = 'INSERT OR REPLACE' if table == 'settings' else 'INSERT'
+    # Строки без даты создания получают время импорта, как при обычной вставке
+    values = ', '.join('COALESCE(?, CURRENT_TIMESTAMP)' if column == 'created_at' else '?' for column in columns)
+    return f"{verb} INTO {table} ({', '.join(columns)}) VALUES ({values})"
+
+def _build_staging(path: str, records: Iterable, progress: Optional[Callable[[int], None]]) -> int:
+    """Загрузить витрину во временную базу path и проверить ее (выполняется в отдельном потоке)"""
+    tables = _EXPORT_TABLES['catalog'] + ['settings']
+    # Схема таблиц - как в рабочей базе, со всеми ограничениями (NOT NULL, UNIQUE, FOREIGN KEY)
+    live = sqlite3.connect(f'file:{DB_NAME}?mode=ro', uri=True, timeout=30.0)
+    try:
+        placeholders = ', '.join('?' * len(tables))
+        schema = live.execute(
+            f"SELECT sql FROM sqlite_master WHERE type = 'table' AND name IN ({placeholders})", tables
+        ).fetchall()
+    finally:
+        live.close()
+    
+    conn = sqlite3.connect(path, isolation_level=None)
+    try:
+        # Временная база не нужна после сбоя
+        conn.execute('PRAGMA journal_mode = OFF')
+        conn.execute('PRAGMA synchronous = OFF')
+        conn.execute('BEGIN')
+        for (sql,) in schema:
+            conn.execute(sql)
+        imported = 0
+        for table, rows in _import_batches(records, 'catalog', IMPORT_BATCH_SIZE):
+            conn.executemany(_insert_sql(table), rows)
+            imported += len(rows)
+            if progress:
+                progress(imported)
+        broken = conn.execute('PRAGMA foreign_key_check').fetchall()
+        if broken:
+            table, rowid, parent, _ = broken[0]
+            raise ValueError(
+                f'Ссылки на несуществующие записи: {len(broken)} '
+                f'(например, {table} id={rowid} ссылается на отсутствующую запись в {parent})'
             )
-        await db.commit()
-        
-        # Импортируем иконку
-        if 'product_icon' in data:
-            await set_setting('product_icon', data['product_icon'])
-            await db.commit()
-
-async def export_data() -> Dict:
-    """Экспорт данных (клиенты, заказы)"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
-        
-        # Клиенты
-        async with db.execute('SELECT * FROM users') as cursor:
-            users = [dict(row) async for row in cursor]
-        
-        # Заказы
-        async with db.execute('SELECT * FROM orders') as cursor:
-            orders = [dict(row) async for row in cursor]
+        conn.execute('COMMIT')
+        return imported
+    finally:
+        conn.close()
+
+async def _swap_catalog(db, staging: str):
+    """Заменить витрину данными из проверенной временной базы одной короткой транзакцией"""
+    # ATTACH невозможен внутри транзакции, поэтому операция выполняется вне общей транзакции писателя
+    await db.execute('ATTACH DATABASE ? AS staging', (staging,))
+    try:
+        await db.execute('BEGIN IMMEDIATE')
+        for table in reversed(_EXPORT_TABLES['catalog']):
+            await db.execute(f'DELETE FROM main.{table}')
+        for table in _EXPORT_TABLES['catalog']:
+            columns = ', '.join(_IMPORT_COLUMNS[table])
+            await db.execute(f'INSERT INTO main.{table} ({columns}) SELECT {columns} FROM staging.{table}')
+        await db.execute('INSERT OR REPLACE INTO main.settings (key, value) SELECT key, value FROM staging.settings')
+        await db.execute('COMMIT')
+    finally:
+        if db.in_transaction:
+            await db.execute('ROLLBACK')
+        await db.execute('DETACH DATABASE staging')
+
+@asynccontextmanager
+async def _staged_catalog(records: Iterable, progress: Optional[Callable[[int], None]]):
+    """Временная база с проверенной витриной из файла: (путь, количество записей)"""
+    fd, staging = tempfile.mkstemp(prefix='catalog_import_', suffix='.db',
+                                   dir=os.path.dirname(os.path.abspath(DB_NAME)))
+    os.close(fd)
+    try:
+        imported = await asyncio.to_thread(_build_staging, staging, records, progress)
+        yield staging, imported
+    finally:
+        os.remove(staging)
+
+async def import_catalog(records: Iterable, progress: Optional[Callable[[int], None]] = None) -> int:
+    """Импорт витрины без простоя. Возвращает количество записей.
+
+    Файл загружается и проверяется во временной базе, пока витрина работает
+    как прежде; затем таблицы подменяются одной короткой транзакцией. Если файл
+    поврежден или не проходит проверку, витрина не меняется.
+    progress вызывается из рабочего потока.
+    """
+    async with _staged_catalog(records, progress) as (staging, imported):
+        async def op(db):
+            await _swap_catalog(db, staging)
+        await _write(op, transaction=False)
+    await _reload_catalog()
+    await _publish('catalog')
+    return imported
+
+# Таблицы витрины, которые сравниваются по id
+_DIFF_TABLES = ['products', 'cities', 'districts', 'payment_methods']
+# Связи сравниваются по (район, товар): их id ни на что не ссылаются
+_LINKS_REMOVED = '''SELECT district_id, product_id FROM main.district_products
+    EXCEPT SELECT district_id, product_id FROM staging.district_products'''
+_LINKS_ADDED = '''SELECT district_id, product_id FROM staging.district_products
+    EXCEPT SELECT district_id, product_id FROM main.district_products'''
+
+def _diff_catalog(staging: str) -> Dict:
+    """Отличия временной базы от рабочей витрины (выполняется в отдельном потоке)"""
+    conn = sqlite3.connect(f'file:{DB_NAME}?mode=ro', uri=True, timeout=30.0, isolation_level=None)
+    try:
+        conn.execute('ATTACH DATABASE ? AS staging', (staging,))
+        # Все сравнения - по одному снимку рабочей базы
+        conn.execute('BEGIN')
+        def ids(sql: str, params: tuple = ()) -> List:
+            return [row[0] for row in conn.execute(sql, params)]
+        changes = {}
+        for table in _DIFF_TABLES:
+            differs = ' OR '.join(f's.{column} IS NOT m.{column}' for column in _IMPORT_COLUMNS[table] if column != 'id')
+            changes[table] = {
+                'added': ids(f'SELECT id FROM staging.{table} WHERE id NOT IN (SELECT id FROM main.{table})'),
+                'updated': ids(f'SELECT s.id FROM staging.{table} s JOIN main.{table} m ON m.id = s.id WHERE {differs}'),
+                'deleted': ids(f'SELECT id FROM main.{table} WHERE id NOT IN (SELECT id FROM staging.{table})'),
+            }
+        changes['links_removed'] = conn.execute(_LINKS_REMOVED).fetchall()
+        changes['links_added'] = conn.execute(_LINKS_ADDED).fetchall()
+        changes['settings'] = ids('''
+            SELECT s.key FROM staging.settings s LEFT JOIN main.settings m ON m.key = s.key
+            WHERE m.value IS NOT s.value
+        ''')
         
-        return {
-            'users': users,
-            'orders': orders
+        # Города, чьи записи кэша устарели: прежний город района - из рабочей базы, новый - из файла
+        districts = changes['districts']
+        city_ids = set(changes['cities']['added'] + changes['cities']['updated'] + changes['cities']['deleted'])
+        city_ids.update(ids('SELECT city_id FROM main.districts WHERE id IN (SELECT value FROM json_each(?))',
+                            (json.dumps(districts['updated'] + districts['deleted']),)))
+        city_ids.update(ids('SELECT city_id FROM staging.districts WHERE id IN (SELECT value FROM json_each(?))',
+                            (json.dumps(districts['updated'] + districts['added']),)))
+        city_ids.update(ids(f'SELECT d.city_id FROM ({_LINKS_REMOVED}) l JOIN main.districts d ON d.id = l.district_id'))
+        city_ids.update(ids(f'SELECT d.city_id FROM ({_LINKS_ADDED}) l JOIN staging.districts d ON d.id = l.district_id'))
+        changes['city_ids'] = [city_id for city_id in city_ids if city_id is not None]
+        conn.execute('COMMIT')
+        return changes
+    finally:
+        conn.close()
+
+async def _apply_catalog_diff(db, staging: str, changes: Dict):
+    """Применить найденные отличия одной транзакцией: меняются только эти строки"""
+    await db.execute('ATTACH DATABASE ? AS staging', (staging,))
+    try:
+        await db.execute('BEGIN IMMEDIATE')
+        await db.executemany('DELETE FROM main.district_products WHERE district_id = ? AND product_id = ?',
+                             changes['links_removed'])
+        # Измененные строки удаляются вместе с удаленными и вставляются из файла заново
+        # (внешние ключи в рабочей базе не проверяются). Построчный UPDATE нарушил бы UNIQUE,
+        # если строки обмениваются значениями (коды способов оплаты, названия городов),
+        # а так в таблице в любой момент только строки из файла, которые уже прошли проверку.
+        for table in reversed(_DIFF_TABLES):
+            await db.execute(f'DELETE FROM main.{table} WHERE id IN (SELECT value FROM json_each(?))',
+                             (json.dumps(changes[table]['deleted'] + changes[table]['updated']),))
+        for table in _DIFF_TABLES:
+            columns = ', '.join(_IMPORT_COLUMNS[table])
+            await db.execute(f'''
+                INSERT INTO main.{table} ({columns})
+                SELECT {columns} FROM staging.{table} WHERE id IN (SELECT value FROM json_each(?))
+            ''', (json.dumps(changes[table]['updated'] + changes[table]['added']),))
+        await db.executemany('INSERT INTO main.district_products (district_id, product_id) VALUES (?, ?)',
+                             changes['links_added'])
+        await db.execute('''
+            INSERT OR REPLACE INTO main.settings (key, value)
+            SELECT key, value FROM staging.settings WHERE key IN (SELECT value FROM json_each(?))
+        ''', (json.dumps(changes['settings']),))
+        await db.execute('COMMIT')
+    finally:
+        if db.in_transaction:
+            await db.execute('ROLLBACK')
+        await db.execute('DETACH DATABASE staging')
+
+async def sync_catalog(records: Iterable, progress: Optional[Callable[[int], None]] = None) -> Dict[str, Dict[str, int]]:
+    """Обновить витрину по файлу, применив только отличия (добавления, изменения, удаления).
+
+    Файл проверяется так же, как при полном импорте, и сравнивается с витриной
+    в отдельном потоке; писатель занят только записью самих изменений.
+    Сбрасываются только записи кэша затронутых городов, районов, товаров
+    и способов оплаты. Возвращает {таблица: {'added', 'updated', 'deleted'}}.
+    """
+    async with _staged_catalog(records, progress) as (staging, _):
+        changes = await asyncio.to_thread(_diff_catalog, staging)
+        summary = {table: {kind: len(ids) for kind, ids in changes[table].items()} for table in _DIFF_TABLES}
+        summary['district_products'] = {
+            'added': len(changes['links_added']), 'updated': 0, 'deleted': len(changes['links_removed'])
         }
+        summary['settings'] = {'added': 0, 'updated': len(changes['settings']), 'deleted': 0}
+        if not any(any(counts.values()) for counts in summary.values()):
+            return summary
+        async def op(db):
+            await _apply_catalog_diff(db, staging, changes)
+        await _write(op, transaction=False)
+    
+    tags = [('city', city_id) for city_id in changes['city_ids']]
+    tags += [('district', district_id) for ids in changes['districts'].values() for district_id in ids]
+    tags += [('product', product_id) for ids in changes['products'].values() for product_id in ids]
+    if any(changes['payment_methods'].values()):
+        tags.append(('payment_methods',))
+    if tags:
+        await _invalidate(*tags)
+    if any(changes['cities'].values()):
+        await _cities_changed()
+    if changes['settings']:
+        await _load_settings()
+        await _publish('settings')
+    return summary
 
-async def import_data(data: Dict):
-    """Импорт данных"""
-    async with aiosqlite.connect(DB_NAME, timeout=30.0) as db:
-        # Очищаем старые данные
-        await db.execute('DELETE FROM orders')
-        await db.execute('DELETE FROM users')
-        await db.commit()
+async def import_data(records: Iterable, progress: Optional[Callable[[int], None]] = None) -> int:
+    """Импорт данных (клиенты, заказы) в одной транзакции. Возвращает количество записей"""
+    # Импорт заменяет всех клиентов, в том числе еще не записанных
+    await flush_users()
+    async def op(db):
+        imported = await _import_records(db, records, 'data', progress)
+        await _rebuild_rollup(db)
         
-        # Импортируем клиентов
-        for user in data.get('users', []):
-            await db.execute(
-                'INSERT INTO users (id, username, first_name, last_name, blocked, created_at) VALUES (?, ?, ?, ?, ?, ?)',
-                (user['id'], user.get('username'), user.get('first_name'), user.get('last_name'), 
-                 user.get('blocked', 0), user.get('created_at'))
+        # Продолжаем нумерацию после импортированных заявок
+        await db.execute('''
+            UPDATE order_counter
+            SET next_number = COALESCE((SELECT MAX(order_number) + 1 FROM orders), ?)
+            WHERE id = 1
+        ''', (INITIAL_ORDER_NUMBER,))
+        return imported
+    imported = await _write(op)
+    _user_fingerprints.clear()
+    await _load_blocked()
+    await _publish('blocked')
+    # Другие обработчики тоже должны забыть записанные профили: удаленные импортом
+    # клиенты иначе не будут записаны заново при следующем /start
+    await _publish('users')
+    return imported
+
+# Состояния FSM
+async def get_fsm_record(key: str) -> Optional[Dict]:
+    """Сохраненное состояние и данные диалога"""
+    async with _connection() as db:
+        async with db.execute('SELECT state, data, updated_at FROM fsm_states WHERE key = ?', (key,)) as cursor:
+            row = await cursor.fetchone()
+            return dict(row) if row else None
+
+async def save_fsm_records(records: List[tuple], deleted: List[str]):
+    """Записать пачку состояний (key, state, data, updated_at) и удалить пустые"""
+    async def op(db):
+        if records:
+            await db.executemany('''
+                INSERT INTO fsm_states (key, state, data, updated_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET
+                    state = excluded.state, data = excluded.data, updated_at = excluded.updated_at
+            ''', records)
+        if deleted:
+            await db.executemany('DELETE FROM fsm_states WHERE key = ?', [(key,) for key in deleted])
+    await _write(op)
+
+async def delete_expired_fsm_records(ttls: Dict[str, float], default_ttl: float, now: float) -> List[Dict]:
+    """Удалить диалоги, которые не менялись дольше срока своей группы состояний"""
+    groups = list(ttls.items())
+    ttl_expr = 'CASE ' + ' '.join('WHEN state LIKE ? THEN ?' for _ in groups) + ' ELSE ? END' if groups else '?'
+    params = [value for group, ttl in groups for value in (f'{group}:%', ttl)]
+    async def op(db):
+        async with db.execute(f'''
+            DELETE FROM fsm_states
+            WHERE updated_at < ? - {ttl_expr}
+            RETURNING key, length(data) + COALESCE(length(state), 0) AS size
+        ''', [now, *params, default_ttl]) as cursor:
+            return [dict(row) async for row in cursor]
+    return await _write(op)
+
+# Очередь исходящих сообщений
+async def _enqueue(db, messages: List[tuple]):
+    now = time.time()
+    await db.executemany(
+        'INSERT INTO outbox (chat_id, text, next_attempt_at, created_at) VALUES (?, ?, ?, ?)',
+        [(chat_id, text, now, now) for chat_id, text in messages]
+    )
+
+async def enqueue_messages(messages: List[tuple]):
+    """Поставить сообщения (chat_id, text) в очередь на отправку"""
+    if not messages:
+        return
+    async def op(db):
+        await _enqueue(db, messages)
+    await _write(op)
+
+async def get_due_messages(now: float, limit: int, shard: Optional[tuple] = None) -> List[Dict]:
+    """Сообщения, время отправки которых наступило.
+
+    Из каждого чата берется только самое раннее сообщение очереди: пока оно
+    отложено (повтор после ошибки), следующие в тот же чат ждут его.
+    """
+    condition, params = _shard_filter(shard, 'chat_id')
+    async with _connection() as db:
+        async with db.execute(f'''
+            SELECT id, chat_id, text, attempts FROM outbox
+            WHERE next_attempt_at <= ?{condition}
+              AND NOT EXISTS (SELECT 1 FROM outbox earlier WHERE earlier.chat_id = outbox.chat_id AND earlier.id < outbox.id)
+            ORDER BY id LIMIT ?
+        ''', (now, *params, limit)) as cursor:
+            return [dict(row) async for row in cursor]
+
+async def get_next_message_time(shard: Optional[tuple] = None) -> Optional[float]:
+    """Когда наступит время отправки ближайшего сообщения"""
+    condition, params = _shard_filter(shard, 'chat_id')
+    async with _connection() as db:
+        async with db.execute(f'SELECT MIN(next_attempt_at) FROM outbox WHERE 1{condition}', params) as cursor:
+            return (await cursor.fetchone())[0]
+
+async def finish_messages(done: List[int], retries: List[tuple]):
+    """Удалить отправленные сообщения и отложить повторы (id, attempts, next_attempt_at)"""
+    async def op(db):
+        if done:
+            await db.executemany('DELETE FROM outbox WHERE id = ?', [(message_id,) for message_id in done])
+        if retries:
+            await db.executemany(
+                'UPDATE outbox SET attempts = ?, next_attempt_at = ? WHERE id = ?',
+                [(attempts, next_attempt_at, message_id) for message_id, attempts, next_attempt_at in retries]
             )
-        await db.commit()
-        
-        # Импортируем заказы
-        for order in data.get('orders', []):
-            await db.execute('''
-                INSERT INTO orders (id, order_number, user_id, product_id, city_id, district_id,
-                                  payment_method, amount_rub, amount_currency, currency_code, status, created_at)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (order['id'], order['order_number'], order['user_id'], order.get('product_id'),
-                  order.get('city_id'), order.get('district_id'), order.get('payment_method'),
-                  order.get('amount_rub'), order.get('amount_currency'), order.get('currency_code'),
-                  order.get('status', 'pending'), order.get('created_at')))
-        await db.commit()
+    await _write(op)
@@ -1,14 +1,16 @@
+import asyncio
 from aiogram import Router, F
 from aiogram.types import Message, FSInputFile
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-import json
-from datetime import datetime, timedelta
+import os
+from datetime import datetime, timedelta, timezone
+from html import escape
 
 import database as db
 import keyboards as kb
-from config import ADMIN_IDS
+from config import ADMIN_IDS, IMPORT_PROGRESS_INTERVAL
 
 router = Router()
 
@@ -57,8 +59,13 @@ class AdminStates(StatesGroup):
     blocking_user = State()
     unblocking_user = State()
     
+    # Импорт
+    importing_catalog_diff = State()
+    
     # Статистика
     stats_period = State()
+    stats_breakdown_dimension = State()
+    stats_breakdown_period = State()
     
     # Настройки
     setting_operator_link = State()
@@ -1104,7 +1111,28 @@ async def stats_menu(message: Message, state: FSMContext):
     await message.answer(
         "📊 <b>Статистика</b>\n\n"
         "Команды:\n"
-        "/stats - Статистика заказов",
+        "/stats - Статистика заказов\n"
+        "/stats_by - Разбивка по городам, районам, товарам и способам оплаты\n"
+        "/cache_stats - Статистика кэша витрины",
+        parse_mode='HTML'
+    )
+
+@router.message(Command("cache_stats"))
+async def cache_stats(message: Message):
+    if not is_admin(message.from_user.id):
+        return
+    
+    stats = db.get_cache_stats()
+    requests_total = stats['hits'] + stats['misses']
+    hit_rate = stats['hits'] / requests_total * 100 if requests_total else 0
+    
+    await message.answer(
+        f"🗄 <b>Кэш витрины</b>\n\n"
+        f"Записей: {stats['entries']}\n"
+        f"Попаданий: {stats['hits']}\n"
+        f"Промахов: {stats['misses']}\n"
+        f"Вытеснено: {stats['evictions']}\n"
+        f"Доля попаданий: {hit_rate:.1f}%",
         parse_mode='HTML'
     )
 
@@ -1124,6 +1152,10 @@ async def stats_start(message: Message, state: FSMContext):
     )
     await state.set_state(AdminStates.stats_period)
 
+def _utc(moment: datetime) -> str:
+    """Местное время в формате created_at заявок (CURRENT_TIMESTAMP, UTC)"""
+    return moment.astimezone(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
 @router.message(AdminStates.stats_period)
 async def stats_show(message: Message, state: FSMContext):
     try:
@@ -1132,16 +1164,16 @@ async def stats_show(message: Message, state: FSMContext):
         now = datetime.now()
         
         if choice == 1:
-            start_date = now.replace(hour=0, minute=0, second=0).isoformat()
-            end_date = now.isoformat()
+            start_date = _utc(now.replace(hour=0, minute=0, second=0))
+            end_date = _utc(now)
             period_name = "сегодня"
         elif choice == 2:
-            start_date = (now - timedelta(days=7)).isoformat()
-            end_date = now.isoformat()
+            start_date = _utc(now - timedelta(days=7))
+            end_date = _utc(now)
             period_name = "за неделю"
         elif choice == 3:
-            start_date = (now - timedelta(days=30)).isoformat()
-            end_date = now.isoformat()
+            start_date = _utc(now - timedelta(days=30))
+            end_date = _utc(now)
             period_name = "за месяц"
         elif choice == 4:
             start_date = None
@@ -1151,17 +1183,20 @@ async def stats_show(message: Message, state: FSMContext):
             await message.answer("❌ Неверный выбор. Введите число от 1 до 4:")
             return
         
-        total_orders = await db.get_orders_count(start_date, end_date)
-        paid_orders = await db.get_orders_by_status('paid', start_date, end_date)
-        pending_orders = await db.get_orders_by_status('pending', start_date, end_date)
-        cancelled_orders = await db.get_orders_by_status('cancelled', start_date, end_date)
+        order_stats = await db.get_order_stats(start_date, end_date)
+        empty = {'count': 0, 'amount': 0}
+        paid = order_stats.get('paid', empty)
+        pending = order_stats.get('pending', empty)
+        cancelled = order_stats.get('cancelled', empty)
+        total_orders = sum(row['count'] for row in order_stats.values())
         
         stats_text = (
             f"📊 <b>Статистика {period_name}</b>\n\n"
             f"Всего заказов: {total_orders}\n"
-            f"✅ Оплачено: {len(paid_orders)}\n"
-            f"⏳ В ожидании: {len(pending_orders)}\n"
-            f"❌ Отменено: {len(cancelled_orders)}"
+            f"✅ Оплачено: {paid['count']}\n"
+            f"⏳ В ожидании: {pending['count']}\n"
+            f"❌ Отменено: {cancelled['count']}\n\n"
+            f"💰 Выручка: {paid['amount']:.2f}₽"
         )
         
         await message.answer(stats_text, parse_mode='HTML')
@@ -1169,6 +1204,83 @@ async def stats_show(message: Message, state: FSMContext):
     except ValueError:
         await message.answer("❌ Неверный формат. Введите число от 1 до 4:")
 
+STATS_BREAKDOWNS = {
+    '1': ('city', 'по городам'),
+    '2': ('district', 'по районам'),
+    '3': ('product', 'по товарам'),
+    '4': ('payment', 'по способам оплаты'),
+}
+
+# Период: (сколько последних дней, включая сегодняшний, подпись).
+# Сводка ведется по целым дням, поэтому неделя - это 7 календарных дней,
+# а не 8, как получилось бы при отсчете от того же числа неделю назад.
+STATS_BREAKDOWN_PERIODS = {
+    '1': (1, 'сегодня'),
+    '2': (7, 'за неделю'),
+    '3': (30, 'за месяц'),
+    '4': (None, 'за все время'),
+}
+
+@router.message(Command("stats_by"))
+async def stats_breakdown_start(message: Message, state: FSMContext):
+    if not is_admin(message.from_user.id):
+        return
+    
+    await message.answer(
+        "📊 <b>Разбивка продаж</b>\n\n"
+        "Выберите разрез:\n"
+        "1. По городам\n"
+        "2. По районам\n"
+        "3. По товарам\n"
+        "4. По способам оплаты",
+        parse_mode='HTML'
+    )
+    await state.set_state(AdminStates.stats_breakdown_dimension)
+
+@router.message(AdminStates.stats_breakdown_dimension)
+async def stats_breakdown_dimension(message: Message, state: FSMContext):
+    if message.text not in STATS_BREAKDOWNS:
+        await message.answer("❌ Неверный выбор. Введите число от 1 до 4:")
+        return
+    
+    await state.update_data(breakdown=message.text)
+    await message.answer(
+        "Выберите период:\n"
+        "1. За сегодня\n"
+        "2. За неделю\n"
+        "3. За месяц\n"
+        "4. За все время"
+    )
+    await state.set_state(AdminStates.stats_breakdown_period)
+
+@router.message(AdminStates.stats_breakdown_period)
+async def stats_breakdown_show(message: Message, state: FSMContext):
+    if message.text not in STATS_BREAKDOWN_PERIODS:
+        await message.answer("❌ Неверный выбор. Введите число от 1 до 4:")
+        return
+    
+    data = await state.get_data()
+    dimension, dimension_name = STATS_BREAKDOWNS[data['breakdown']]
+    days, period_name = STATS_BREAKDOWN_PERIODS[message.text]
+    # Дни в сводке считаются по местному времени, как и здесь
+    since_day = (datetime.now().date() - timedelta(days=days - 1)).isoformat() if days is not None else None
+    
+    rows = await db.get_sales_breakdown(dimension, since_day)
+    await state.clear()
+    
+    if not rows:
+        await message.answer(f"📊 Заказов {period_name} нет")
+        return
+    
+    text = f"📊 <b>Продажи {dimension_name} {period_name}</b>\n\n"
+    for row in rows:
+        text += (
+            f"<b>{escape(str(row['name']))}</b>\n"
+            f"Заказов: {row['total']}, ✅ {row['paid']}, ❌ {row['cancelled']}, "
+            f"💰 {row['revenue']:.2f}₽\n\n"
+        )
+    await message.answer(text, parse_mode='HTML')
+
 # === БЭКАП ===
 @router.message(Command("export_catalog"))
 async def export_catalog(message: Message):
@@ -1177,13 +1289,10 @@ async def export_catalog(message: Message):
         await message.answer("❌ У вас нет доступа к этой команде")
         return
     
+    filename = f'catalog_{datetime.now().strftime("%Y%m%d_%H%M%S")}.ndjson.gz'
     try:
-        data = await db.export_catalog()
-        
-        # Сохраняем в JSON
-        filename = f'catalog_{datetime.now().strftime("%Y%m%d_%H%M%S")}.json'
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        # Файл пишется в отдельном потоке, бот в это время продолжает работать
+        await db.export_catalog(filename)
         
         file = FSInputFile(filename)
         await message.answer_document(
@@ -1191,12 +1300,12 @@ async def export_catalog(message: Message):
             caption="📦 Экспорт витрины (товары, города, районы, способы оплаты)\n\n"
                     "Для импорта используйте /import_catalog"
         )
-        
-        # Удаляем временный файл
-        import os
-        os.remove(filename)
     except Exception as e:
         await message.answer(f"❌ Ошибка при экспорте: {e}")
+    finally:
+        # Удаляем временный файл
+        if os.path.exists(filename):
+            os.remove(filename)
 
 @router.message(Command("import_catalog"))
 async def import_catalog_start(message: Message):
@@ -1207,10 +1316,27 @@ async def import_catalog_start(message: Message):
     
     await message.answer(
         "📥 <b>Импорт витрины</b>\n\n"
-        "Отправьте JSON файл с витриной\n\n"
-        "⚠️ <b>ВНИМАНИЕ:</b> Текущая витрина будет полностью заменена!",
+        "Отправьте файл экспорта витрины (.ndjson.gz или .json)\n\n"
+        "⚠️ <b>ВНИМАНИЕ:</b> Текущая витрина будет полностью заменена!\n\n"
+        "Чтобы применить только отличия файла от текущей витрины, используйте /import_catalog_diff",
+        parse_mode='HTML'
+    )
+
+@router.message(Command("import_catalog_diff"))
+async def import_catalog_diff_start(message: Message, state: FSMContext):
+    """Начало обновления витрины по отличиям"""
+    if not is_admin(message.from_user.id):
+        await message.answer("❌ У вас нет доступа к этой команде")
+        return
+    
+    await message.answer(
+        "📥 <b>Обновление витрины</b>\n\n"
+        "Отправьте файл экспорта витрины (.ndjson.gz или .json)\n\n"
+        "Будут добавлены новые, изменены отличающиеся и удалены отсутствующие в файле "
+        "товары, города, районы и способы оплаты. Остальное не изменится.",
         parse_mode='HTML'
     )
+    await state.set_state(AdminStates.importing_catalog_diff)
 
 @router.message(Command("export_data"))
 async def export_data(message: Message):
@@ -1219,13 +1345,9 @@ async def export_data(message: Message):
         await message.answer("❌ У вас нет доступа к этой команде")
         return
     
+    filename = f'data_{datetime.now().strftime("%Y%m%d_%H%M%S")}.ndjson.gz'
     try:
-        data = await db.export_data()
-        
-        # Сохраняем в JSON
-        filename = f'data_{datetime.now().strftime("%Y%m%d_%H%M%S")}.json'
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        await db.export_data(filename)
         
         file = FSInputFile(filename)
         await message.answer_document(
@@ -1233,12 +1355,12 @@ async def export_data(message: Message):
             caption="📦 Экспорт данных (клиенты, заказы)\n\n"
                     "Для импорта используйте /import_data"
         )
-        
-        # Удаляем временный файл
-        import os
-        os.remove(filename)
     except Exception as e:
         await message.answer(f"❌ Ошибка при экспорте: {e}")
+    finally:
+        # Удаляем временный файл
+        if os.path.exists(filename):
+            os.remove(filename)
 
 @router.message(Command("import_data"))
 async def import_data_start(message: Message):
@@ -1249,45 +1371,103 @@ async def import_data_start(message: Message):
     
     await message.answer(
         "📥 <b>Импорт данных</b>\n\n"
-        "Отправьте JSON файл с данными\n\n"
+        "Отправьте файл экспорта данных (.ndjson.gz или .json)\n\n"
         "⚠️ <b>ВНИМАНИЕ:</b> Текущие данные будут полностью заменены!",
         parse_mode='HTML'
     )
 
+async def report_import_progress(status: Message, imported: dict):
+    """Периодически показывать админу, сколько записей уже импортировано"""
+    shown = 0
+    while True:
+        await asyncio.sleep(IMPORT_PROGRESS_INTERVAL)
+        if imported['count'] == shown:
+            continue
+        shown = imported['count']
+        try:
+            await status.edit_text(f"⏳ Импорт... Записей: {shown}")
+        except Exception:
+            # Прогресс необязателен, импорт продолжается
+            pass
+
+CATALOG_DIFF_TABLES = {
+    'products': 'Товары',
+    'cities': 'Города',
+    'districts': 'Районы',
+    'district_products': 'Товары в районах',
+    'payment_methods': 'Способы оплаты',
+    'settings': 'Настройки',
+}
+
+def format_catalog_diff(summary: dict) -> str:
+    """Сводка изменений витрины для админа"""
+    lines = []
+    for table, title in CATALOG_DIFF_TABLES.items():
+        counts = summary[table]
+        if not any(counts.values()):
+            continue
+        parts = []
+        if counts['added']:
+            parts.append(f"добавлено {counts['added']}")
+        if counts['updated']:
+            parts.append(f"изменено {counts['updated']}")
+        if counts['deleted']:
+            parts.append(f"удалено {counts['deleted']}")
+        lines.append(f"{title}: {', '.join(parts)}")
+    if not lines:
+        return "✅ Витрина уже совпадает с файлом, изменений нет"
+    return "✅ Витрина обновлена\n\n" + "\n".join(lines)
+
 @router.message(F.document)
-async def import_file(message: Message):
+async def import_file(message: Message, state: FSMContext):
     """Импорт файла"""
     if not is_admin(message.from_user.id):
         return
     
     filename = message.document.file_name
+    diff = await state.get_state() == AdminStates.importing_catalog_diff.state
+    await state.clear()
     
     try:
         # Скачиваем файл
         file = await message.bot.get_file(message.document.file_id)
         await message.bot.download_file(file.file_path, filename)
         
-        # Читаем JSON
-        with open(filename, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        
-        # Определяем тип файла
-        if 'products' in data and 'cities' in data:
-            # Это витрина
-            await db.import_catalog(data)
-            await message.answer("✅ Витрина успешно импортирована!")
-        elif 'users' in data and 'orders' in data:
-            # Это данные
-            await db.import_data(data)
-            await message.answer("✅ Данные успешно импортированы!")
-        else:
+        # Определяем тип файла (NDJSON.gz или JSON из старых версий бота)
+        kind, records = await asyncio.to_thread(db.open_import, filename)
+        if kind is None:
             await message.answer("❌ Неверный формат файла")
+            return
+        if diff and kind != 'catalog':
+            records.close()
+            await message.answer("❌ Для обновления нужен файл экспорта витрины (/export_catalog)")
+            return
         
-        # Удаляем временный файл
-        import os
-        os.remove(filename)
+        status = await message.answer("⏳ Импорт...")
+        imported = {'count': 0}
+        reporter = asyncio.create_task(report_import_progress(status, imported))
+        def progress(count: int):
+            imported['count'] = count
+        try:
+            if diff:
+                summary = await db.sync_catalog(records, progress)
+                await status.edit_text(format_catalog_diff(summary))
+            elif kind == 'catalog':
+                count = await db.import_catalog(records, progress)
+                await status.edit_text(f"✅ Витрина успешно импортирована! Записей: {count}")
+            else:
+                count = await db.import_data(records, progress)
+                await status.edit_text(f"✅ Данные успешно импортированы! Записей: {count}")
+        finally:
+            reporter.cancel()
+            # Закрываем файл, даже если импорт прерван ошибкой
+            records.close()
     except Exception as e:
         await message.answer(f"❌ Ошибка при импорте: {e}")
+    finally:
+        # Удаляем временный файл
+        if os.path.exists(filename):
+            os.remove(filename)
 
 # === НАСТРОЙКИ ===
 @router.message(F.text == "⚙️ Настройки")
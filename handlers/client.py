@@ -3,10 +3,11 @@ from aiogram.types import Message, CallbackQuery
 from aiogram.filters import CommandStart
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-import asyncio
 
 import database as db
 import keyboards as kb
+from outbox import outbox
+from scheduler import payment_timeouts
 
 router = Router()
 
@@ -21,10 +22,7 @@ class OrderStates(StatesGroup):
 @router.message(CommandStart())
 async def cmd_start(message: Message, state: FSMContext):
     """Начало работы с ботом"""
-    # Проверяем блокировку
-    if await db.is_user_blocked(message.from_user.id):
-        await message.answer("❌ Вы заблокированы")
-        return
+    # Заблокированных клиентов отсекает BlockedUserMiddleware
     
     # Сохраняем пользователя
     await db.add_or_update_user(
@@ -56,6 +54,12 @@ async def main_menu(callback: CallbackQuery, state: FSMContext):
 async def process_city_input(message: Message, state: FSMContext):
     """Обработка ввода города"""
     city = await db.find_city(message.text)
+    question = f"Ваш город: {city['name']}?" if city else None
+    
+    if not city:
+        # Возможно, в названии опечатка
+        city = await db.find_similar_city(message.text)
+        question = f"Возможно, вы имели в виду: {city['name']}?" if city else None
     
     if not city:
         await message.answer(
@@ -66,7 +70,7 @@ async def process_city_input(message: Message, state: FSMContext):
     
     await state.update_data(city_id=city['id'], city_name=city['name'])
     await message.answer(
-        f"Ваш город: {city['name']}?",
+        question,
         reply_markup=kb.city_confirmation_kb(city['name'])
     )
     await state.set_state(OrderStates.city_confirmation)
@@ -263,33 +267,10 @@ async def select_payment(callback: CallbackQuery, state: FSMContext):
     await state.set_state(OrderStates.waiting_payment)
     
     # Запускаем таймер на 30 минут
-    asyncio.create_task(payment_timeout(callback.from_user.id, order_number, state, callback.bot))
+    payment_timeouts.schedule(order_number, callback.from_user.id)
     
     await callback.answer()
 
-async def payment_timeout(user_id: int, order_number: int, state: FSMContext, bot):
-    """Таймер на оплату заявки"""
-    from config import PAYMENT_TIMEOUT
-    await asyncio.sleep(PAYMENT_TIMEOUT)
-    
-    # Проверяем статус заявки
-    order = await db.get_order_by_number(order_number)
-    
-    if order and order['status'] == 'pending':
-        await db.cancel_order(order_number)
-        
-        cancel_message = await db.get_setting(
-            'order_timeout_message',
-            '⏰ Время на оплату заявки истекло. Заявка отменена.'
-        )
-        
-        try:
-            await bot.send_message(user_id, cancel_message)
-        except Exception as e:
-            print(f"Не удалось отправить уведомление об истечении времени: {e}")
-        
-        await state.clear()
-
 @router.callback_query(F.data == "order_paid", OrderStates.waiting_payment)
 async def order_paid(callback: CallbackQuery, state: FSMContext):
     """Клиент нажал "Я оплатил" """
@@ -302,19 +283,18 @@ async def order_paid(callback: CallbackQuery, state: FSMContext):
     order = await db.get_order_by_number(order_number)
     product = await db.get_product_by_id(order['product_id'])
     
-    # Отправляем уведомление администраторам
-    from config import ADMIN_IDS
+    # Отправляем уведомление администраторам (если включена доска заявок,
+    # оплата появится на ней)
+    from config import ADMIN_IDS, ADMIN_BOARD
     
     admin_notification = (
         f"✅ Успешный клиент. Заявка № {order_number}\n"
         f"({product['name']} - {order['amount_currency']} {order['currency_code'].upper()})"
     )
     
-    for admin_id in ADMIN_IDS:
-        try:
-            await callback.bot.send_message(admin_id, admin_notification)
-        except Exception as e:
-            print(f"Не удалось отправить уведомление админу {admin_id}: {e}")
+    # Отправка идет из очереди в фоне, клиент ее не ждет
+    if not ADMIN_BOARD:
+        await outbox.send_many([(admin_id, admin_notification) for admin_id in ADMIN_IDS])
     
     success_message = await db.get_setting(
         'payment_success_message',
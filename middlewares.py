@@ -0,0 +1,35 @@
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+
+import database as db
+from config import ADMIN_IDS
+
+
+class BlockedUserMiddleware(BaseMiddleware):
+    """Отбрасывает обновления заблокированных клиентов до всех обработчиков.
+
+    Проверка идет по множеству в памяти (database.is_blocked), без запроса
+    к базе. Админы не проверяются.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any],
+    ) -> Any:
+        user = data.get('event_from_user')
+        if user is None or user.id in ADMIN_IDS or not db.is_blocked(user.id):
+            return await handler(event, data)
+
+        # Подсказываем только на /start и нажатия кнопок, остальное молча игнорируем
+        try:
+            if event.message and event.message.text and event.message.text.startswith('/start'):
+                await event.message.answer("❌ Вы заблокированы")
+            elif event.callback_query:
+                await event.callback_query.answer("❌ Вы заблокированы")
+        except Exception as e:
+            print(f"Не удалось ответить заблокированному клиенту: {e}")
+        return None
@@ -0,0 +1,156 @@
+import asyncio
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+
+import database as db
+from config import OUTBOX_RATE_LIMIT, OUTBOX_CHAT_INTERVAL, OUTBOX_MAX_ATTEMPTS
+
+# Сколько сообщений читать из очереди за раз
+BATCH_SIZE = 100
+# Как часто проверять очередь, если будить некому (сообщения от других процессов)
+POLL_INTERVAL = 1.0
+
+
+class Outbox:
+    """Очередь исходящих сообщений, сохраняемая в базе.
+
+    Обработчики только записывают сообщения в таблицу outbox и сразу
+    продолжают работу; отправляет их одна фоновая задача не быстрее
+    rate сообщений в секунду и не чаще раза в chat_interval секунд в один чат.
+    На RetryAfter отправка приостанавливается на указанное Telegram время,
+    при сетевых ошибках сообщение повторяется с растущей паузой. Сообщения
+    в один чат уходят в порядке постановки в очередь. Неотправленные
+    сообщения переживают перезапуск (доставка "как минимум один раз").
+    """
+
+    def __init__(self, rate: float, chat_interval: float, max_attempts: int):
+        self.rate = rate
+        self.chat_interval = chat_interval
+        self.max_attempts = max_attempts
+        self._bot: Optional[Bot] = None
+        self._shard: Optional[Tuple[int, int]] = None
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        # Время, раньше которого нельзя отправлять следующее сообщение (общий лимит)
+        self._next_slot = 0.0
+        # Время последней отправки в каждый чат
+        self._last_sent: Dict[int, float] = {}
+
+    async def start(self, bot: Bot, shard: Optional[Tuple[int, int]] = None):
+        """shard = (номер, всего): отправлять только в чаты своего обработчика"""
+        self._bot = bot
+        self._shard = shard
+        # Общий лимит бота делится между обработчиками
+        if shard is not None:
+            self.rate = self.rate / shard[1]
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def send(self, chat_id: int, text: str):
+        """Поставить сообщение в очередь"""
+        await self.send_many([(chat_id, text)])
+
+    async def send_many(self, messages: List[Tuple[int, str]]):
+        """Поставить пачку сообщений (chat_id, text) в очередь одной записью"""
+        await db.enqueue_messages(messages)
+        self.wake()
+
+    def wake(self):
+        """Сообщить, что в очереди появились сообщения"""
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                wait = await self._send_due()
+            except Exception:
+                logging.exception('Ошибка отправки сообщений из очереди')
+                wait = POLL_INTERVAL
+            if wait > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _send_due(self) -> float:
+        """Отправить наступившие сообщения; вернуть, сколько ждать до следующего прохода"""
+        now = time.time()
+        messages = await db.get_due_messages(now, BATCH_SIZE, self._shard)
+        if not messages:
+            next_time = await db.get_next_message_time(self._shard)
+            return POLL_INTERVAL if next_time is None else min(POLL_INTERVAL, max(next_time - now, 0.01))
+
+        done: List[int] = []
+        retries: List[tuple] = []
+        # Чаты, сообщение в которые отложено: следующие в тот же чат не обгоняют его
+        deferred: Dict[int, float] = {}
+        wait = 0.0
+        try:
+            for message in messages:
+                chat_id = message['chat_id']
+                if chat_id in deferred:
+                    retries.append((message['id'], message['attempts'], deferred[chat_id]))
+                    continue
+                allowed_at = self._last_sent.get(chat_id, 0) + self.chat_interval
+                if allowed_at > time.time():
+                    # В этот чат отправляли только что: откладываем, чтобы не загораживать другие чаты
+                    retries.append((message['id'], message['attempts'], allowed_at))
+                    deferred[chat_id] = allowed_at
+                    continue
+
+                delay = self._next_slot - time.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                self._next_slot = max(time.time(), self._next_slot) + 1 / self.rate
+
+                try:
+                    await self._bot.send_message(chat_id, message['text'])
+                    done.append(message['id'])
+                    self._last_sent[chat_id] = time.time()
+                except TelegramRetryAfter as e:
+                    # Лимит Telegram: ждем сколько сказано и не отправляем ничего
+                    resume_at = time.time() + e.retry_after
+                    self._next_slot = resume_at
+                    retries.append((message['id'], message['attempts'], resume_at))
+                    wait = e.retry_after
+                    break
+                except (TelegramForbiddenError, TelegramBadRequest) as e:
+                    # Бот заблокирован или чат не существует: повтор не поможет
+                    logging.warning('Сообщение в чат %s не доставлено: %s', chat_id, e)
+                    done.append(message['id'])
+                except Exception as e:
+                    attempts = message['attempts'] + 1
+                    if attempts >= self.max_attempts:
+                        logging.error('Сообщение в чат %s не доставлено после %s попыток: %s', chat_id, attempts, e)
+                        done.append(message['id'])
+                    else:
+                        retry_at = time.time() + min(2 ** attempts, 300)
+                        retries.append((message['id'], attempts, retry_at))
+                        deferred[chat_id] = retry_at
+        finally:
+            await db.finish_messages(done, retries)
+            self._forget_idle_chats()
+
+        return wait
+
+    def _forget_idle_chats(self):
+        if len(self._last_sent) < 10000:
+            return
+        border = time.time() - self.chat_interval
+        self._last_sent = {chat_id: sent for chat_id, sent in self._last_sent.items() if sent > border}
+
+
+outbox = Outbox(OUTBOX_RATE_LIMIT, OUTBOX_CHAT_INTERVAL, OUTBOX_MAX_ATTEMPTS)
@@ -0,0 +1,134 @@
+import asyncio
+import heapq
+import logging
+import time
+from datetime import datetime, timezone
+from typing import List, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+
+import database as db
+from config import PAYMENT_TIMEOUT, ORDER_SWEEP_INTERVAL
+from outbox import outbox
+
+
+def _created_timestamp(created_at) -> float:
+    """created_at из базы (UTC, CURRENT_TIMESTAMP) -> unix time"""
+    try:
+        created = datetime.fromisoformat(str(created_at))
+    except ValueError:
+        return time.time()
+    if created.tzinfo is None:
+        created = created.replace(tzinfo=timezone.utc)
+    return created.timestamp()
+
+
+class PaymentTimeoutScheduler:
+    """Один планировщик истечения времени на оплату вместо задачи на каждую заявку.
+
+    Дедлайны хранятся в куче (deadline, order_number, user_id) и только
+    подсказывают, когда проснуться: сама отмена - это один запрос
+    UPDATE ... RETURNING по всем просроченным заявкам сразу. Кроме того,
+    проверка выполняется не реже раза в ORDER_SWEEP_INTERVAL секунд.
+    Уведомления клиентам попадают в очередь исходящих сообщений в той же
+    транзакции, что и отмена.
+    """
+
+    def __init__(self, timeout: int, sweep_interval: float):
+        self.timeout = timeout
+        self.sweep_interval = sweep_interval
+        self._heap: List[Tuple[float, int, int]] = []
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._bot: Optional[Bot] = None
+        self._storage: Optional[BaseStorage] = None
+        self._shard: Optional[Tuple[int, int]] = None
+
+    async def start(self, bot: Bot, storage: BaseStorage, shard: Optional[Tuple[int, int]] = None):
+        """shard = (номер, всего): обслуживать только заявки клиентов своего обработчика"""
+        self._bot = bot
+        self._storage = storage
+        self._shard = shard
+        # Всё, что просрочилось за время простоя, отменяется одним запросом
+        await self.sweep()
+        self._heap = [
+            (_created_timestamp(order['created_at']) + self.timeout, order['order_number'], order['user_id'])
+            for order in await db.get_pending_orders(self._shard)
+        ]
+        heapq.heapify(self._heap)
+        logging.info('Восстановлено таймеров оплаты: %s', len(self._heap))
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def schedule(self, order_number: int, user_id: int):
+        """Запустить отсчет времени на оплату новой заявки"""
+        deadline = time.time() + self.timeout
+        heapq.heappush(self._heap, (deadline, order_number, user_id))
+        if self._heap[0][1] == order_number:
+            self._wakeup.set()
+
+    def __len__(self):
+        return len(self._heap)
+
+    async def sweep(self) -> int:
+        """Отменить все просроченные заявки и поставить уведомления в очередь"""
+        cancel_message = await db.get_setting(
+            'order_timeout_message',
+            '⏰ Время на оплату заявки истекло. Заявка отменена.'
+        )
+        expired = await db.expire_stale_orders(self.timeout, self._shard, cancel_message)
+        if not expired:
+            return 0
+        logging.info('Отменено просроченных заявок: %s', len(expired))
+        outbox.wake()
+        for order in expired:
+            try:
+                await self._clear_state(order['user_id'], order['order_number'])
+            except Exception:
+                logging.exception('Не удалось сбросить состояние клиента %s', order['user_id'])
+        return len(expired)
+
+    async def _run(self):
+        next_sweep = time.time() + self.sweep_interval
+        while True:
+            now = time.time()
+            if now >= next_sweep or (self._heap and self._heap[0][0] <= now):
+                # Дедлайн в куче не раньше created_at + timeout, поэтому
+                # запрос по created_at захватывает все наступившие дедлайны
+                while self._heap and self._heap[0][0] <= now:
+                    heapq.heappop(self._heap)
+                try:
+                    await self.sweep()
+                except Exception:
+                    logging.exception('Ошибка при отмене просроченных заявок')
+                next_sweep = now + self.sweep_interval
+                continue
+
+            self._wakeup.clear()
+            wait = next_sweep - now
+            if self._heap:
+                wait = min(wait, self._heap[0][0] - now)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _clear_state(self, user_id: int, order_number: int):
+        """Сбросить диалог клиента, если он все еще ждет оплаты этой заявки"""
+        key = StorageKey(bot_id=self._bot.id, chat_id=user_id, user_id=user_id)
+        data = await self._storage.get_data(key)
+        if data.get('order_number') == order_number:
+            await self._storage.set_state(key, None)
+            await self._storage.set_data(key, {})
+
+
+payment_timeouts = PaymentTimeoutScheduler(PAYMENT_TIMEOUT, ORDER_SWEEP_INTERVAL)
@@ -0,0 +1,55 @@
+"""Замер задержки одного запроса к базе: пул постоянных соединений против
+нового соединения на каждый вызов (как было до пула).
+
+Запуск: python scripts/bench_db_pool.py [--calls 2000]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aiosqlite
+
+import database as db
+
+
+async def get_order_by_number_per_call(order_number: int):
+    """get_order_by_number в прежнем виде: свое соединение на каждый вызов"""
+    async with aiosqlite.connect(db.DB_NAME) as conn:
+        conn.row_factory = aiosqlite.Row
+        async with conn.execute('SELECT * FROM orders WHERE order_number = ?', (order_number,)) as cursor:
+            row = await cursor.fetchone()
+            return dict(row) if row else None
+
+
+async def measure(label: str, get, numbers, calls: int) -> float:
+    started = time.perf_counter()
+    for i in range(calls):
+        assert await get(numbers[i % len(numbers)]) is not None
+    per_call = (time.perf_counter() - started) / calls * 1e6
+    print(f'{label}: {per_call:.0f} мкс/вызов')
+    return per_call
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--calls', type=int, default=2000)
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp(prefix='bench_pool_'))
+    await db.init_db()
+    try:
+        numbers = [await db.create_order(user_id, 1, 1, 1, 'btc', 100.0, 0.001, 'BTC') for user_id in range(100)]
+        before = await measure('соединение на вызов', get_order_by_number_per_call, numbers, args.calls)
+        after = await measure('пул соединений', db.get_order_by_number, numbers, args.calls)
+        print(f'пул быстрее в {before / after:.1f} раза')
+    finally:
+        await db.close_db()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
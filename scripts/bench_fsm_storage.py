@@ -0,0 +1,91 @@
+"""Замер хранилища состояний диалогов: MemoryStorage, SQLiteStorage с отложенной
+записью и SQLiteStorage с записью после каждого изменения.
+
+Запуск: python scripts/bench_fsm_storage.py [--users 2000]
+Каждый клиент проходит воронку заказа (город, товар, район, оплата) с теми же
+вызовами set_state/update_data, что и обработчики в handlers/client.py.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+import database as db
+from config import FSM_DEFAULT_TTL, FSM_FLUSH_INTERVAL, FSM_SESSION_TTL
+from storage import SQLiteStorage
+
+
+class WriteThroughStorage(SQLiteStorage):
+    """SQLiteStorage без объединения записей: сброс в базу после каждого изменения"""
+
+    async def set_state(self, key, state=None):
+        await super().set_state(key, state)
+        await self.flush()
+
+    async def set_data(self, key, data):
+        await super().set_data(key, data)
+        await self.flush()
+
+
+async def funnel(storage, user_id: int):
+    key = StorageKey(bot_id=1, chat_id=user_id, user_id=user_id)
+    await storage.set_state(key, 'OrderStates:waiting_city')
+    await storage.get_state(key)
+    await storage.update_data(key, {'city_id': 1})
+    await storage.set_state(key, 'OrderStates:waiting_product')
+    await storage.get_state(key)
+    await storage.update_data(key, {'product_id': 2, 'price': 100.0})
+    await storage.get_state(key)
+    await storage.update_data(key, {'district_id': 3})
+    await storage.get_data(key)
+    await storage.update_data(key, {'order_number': 10000 + user_id})
+    await storage.set_state(key, 'OrderStates:waiting_payment')
+
+
+async def measure(label: str, storage, users: int):
+    started = time.perf_counter()
+    await asyncio.gather(*[funnel(storage, user_id) for user_id in range(1, users + 1)])
+    elapsed = time.perf_counter() - started
+    started = time.perf_counter()
+    await storage.close()
+    closed = time.perf_counter() - started
+    print(f'{label}: {elapsed * 1000:.0f} мс ({elapsed / users * 1e6:.0f} мкс на клиента), '
+          f'запись при закрытии {closed * 1000:.0f} мс')
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=2000)
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp(prefix='bench_fsm_'))
+    await db.init_db()
+    try:
+        await measure('MemoryStorage', MemoryStorage(), args.users)
+        await measure(f'SQLiteStorage, сброс раз в {FSM_FLUSH_INTERVAL} с',
+                      SQLiteStorage(FSM_FLUSH_INTERVAL, FSM_SESSION_TTL, FSM_DEFAULT_TTL), args.users)
+        await measure('SQLiteStorage, запись после каждого изменения',
+                      WriteThroughStorage(FSM_FLUSH_INTERVAL, FSM_SESSION_TTL, FSM_DEFAULT_TTL), args.users)
+
+        # Состояние переживает перезапуск
+        await db.close_db()
+        await db.init_db()
+        storage = SQLiteStorage(FSM_FLUSH_INTERVAL, FSM_SESSION_TTL, FSM_DEFAULT_TTL)
+        key = StorageKey(bot_id=1, chat_id=7, user_id=7)
+        assert await storage.get_state(key) == 'OrderStates:waiting_payment'
+        assert (await storage.get_data(key))['order_number'] == 10007
+        await storage.close()
+        print('после перезапуска состояние и данные диалога восстановлены')
+    finally:
+        await db.close_db()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,46 @@
+"""Проверка маршрутизации обновлений по обработчикам (BOT_WORKERS > 1).
+
+Запуск: python scripts/check_shard_routing.py
+Обновления одного клиента (сообщение и нажатие кнопки) должны попадать в один процесс,
+и при приёме через webhook, и при пересылке из polling (через модель aiogram).
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiogram.types import Update
+
+from sharding import shard_of, update_json, update_user_id
+
+USER_ID = 777
+WORKERS = 4
+
+MESSAGE = {
+    'update_id': 1,
+    'message': {
+        'message_id': 1, 'date': 1700000000, 'text': '/start',
+        'chat': {'id': USER_ID, 'type': 'private'},
+        'from': {'id': USER_ID, 'is_bot': False, 'first_name': 'U'},
+    },
+}
+CALLBACK = {
+    'update_id': 2,
+    'callback_query': {
+        'id': '1', 'chat_instance': '1', 'data': 'city_1',
+        'from': {'id': USER_ID, 'is_bot': False, 'first_name': 'U'},
+    },
+}
+
+
+def main():
+    expected = USER_ID % WORKERS
+    for name, raw in (('message', MESSAGE), ('callback_query', CALLBACK)):
+        for source, update in (('webhook', raw), ('polling', update_json(Update.model_validate(raw)))):
+            assert update_user_id(update) == USER_ID, f'{name} ({source}): пользователь не найден'
+            assert shard_of(update, WORKERS) == expected, f'{name} ({source}): не тот обработчик'
+    print(f'OK: обновления пользователя {USER_ID} идут в обработчик {expected} из {WORKERS}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""Нагрузочная проверка выдачи номеров заявок.
+
+Запуск: python scripts/stress_order_numbers.py [--orders 5000] [--processes 1]
+Во временной базе параллельно создаются заявки (в нескольких процессах - как при
+BOT_WORKERS > 1) и проверяется, что номера не повторяются, идут без пропусков
+и начинаются с INITIAL_ORDER_NUMBER.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database as db
+from config import INITIAL_ORDER_NUMBER
+
+
+async def prepare():
+    await db.init_db()
+    await db.close_db()
+
+
+async def create_orders(count: int, first_user: int):
+    await db.init_db()
+    try:
+        return await asyncio.gather(*[
+            db.create_order(first_user + i, 1, 1, 1, 'btc', 100.0, 0.001, 'BTC') for i in range(count)
+        ])
+    finally:
+        await db.close_db()
+
+
+def worker(directory: str, count: int, first_user: int):
+    """Процесс-обработчик: своя копия пула и писателя над общей базой"""
+    os.chdir(directory)
+    return asyncio.run(create_orders(count, first_user))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--orders', type=int, default=5000, help='сколько заявок создать всего')
+    parser.add_argument('--processes', type=int, default=1, help='в скольких процессах')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='stress_orders_')
+    os.chdir(directory)
+    # База создается заранее, чтобы процессы не выполняли миграции одновременно
+    asyncio.run(prepare())
+
+    per_process = args.orders // args.processes
+    started = time.perf_counter()
+    if args.processes == 1:
+        numbers = asyncio.run(create_orders(per_process, 1))
+    else:
+        with multiprocessing.get_context('spawn').Pool(args.processes) as pool:
+            parts = pool.starmap(worker, [(directory, per_process, i * per_process + 1) for i in range(args.processes)])
+        numbers = [number for part in parts for number in part]
+    elapsed = time.perf_counter() - started
+
+    total = per_process * args.processes
+    stored = sqlite3.connect(os.path.join(directory, db.DB_NAME)).execute('SELECT order_number FROM orders').fetchall()
+    assert len(numbers) == total, f'создано {len(numbers)} из {total}'
+    assert len(set(numbers)) == total, 'номера заявок повторяются'
+    assert sorted(numbers) == list(range(INITIAL_ORDER_NUMBER, INITIAL_ORDER_NUMBER + total)), 'в номерах есть пропуски'
+    assert sorted(row[0] for row in stored) == sorted(numbers), 'номера в базе не совпадают с выданными'
+    print(f'OK: {total} заявок в {args.processes} процесс(ах) за {elapsed:.2f} с, '
+          f'номера {INITIAL_ORDER_NUMBER}..{INITIAL_ORDER_NUMBER + total - 1} без повторов и пропусков')
+
+
+if __name__ == '__main__':
+    main()
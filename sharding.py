@@ -0,0 +1,140 @@
+import asyncio
+import logging
+import os
+import signal
+import sys
+from typing import Any, Dict, List, Optional
+
+import aiohttp
+from aiogram import Bot
+from aiogram.types import Update
+
+# Заголовок, которым front подписывает пересылаемые обработчикам обновления
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+# Путь, на который обработчики принимают обновления от front
+WORKER_PATH = '/update'
+
+
+def update_user_id(update: Dict[str, Any]) -> Optional[int]:
+    """ID пользователя, от которого пришло обновление (по сырому JSON)"""
+    for key, value in update.items():
+        if key == 'update_id' or not isinstance(value, dict):
+            continue
+        user = value.get('from') or value.get('user')
+        if isinstance(user, dict) and 'id' in user:
+            return user['id']
+        chat = value.get('chat')
+        if isinstance(chat, dict) and 'id' in chat:
+            return chat['id']
+    return None
+
+
+def update_json(update: Update) -> Dict[str, Any]:
+    """Обновление из long polling в виде JSON от Telegram (с полем from, а не from_user)"""
+    return update.model_dump(mode='json', by_alias=True, exclude_unset=True)
+
+
+def shard_of(update: Dict[str, Any], count: int) -> int:
+    """Номер обработчика для обновления: все обновления одного клиента идут в один процесс"""
+    user_id = update_user_id(update)
+    return user_id % count if user_id is not None else 0
+
+
+class WorkerPool:
+    """Процессы-обработчики и пересылка им обновлений.
+
+    Каждый обработчик - это `python bot.py` с BOT_WORKER_INDEX, который
+    принимает обновления по HTTP на 127.0.0.1:(port_base + номер). Для каждого
+    обработчика своя очередь и одна задача пересылки, поэтому обновления
+    одного клиента доставляются по порядку. Упавший процесс перезапускается,
+    а недоставленные обновления ждут в очереди.
+    """
+
+    def __init__(self, count: int, port_base: int, secret: str):
+        self.count = count
+        self.port_base = port_base
+        self.secret = secret
+        self._queues: List[asyncio.Queue] = [asyncio.Queue() for _ in range(count)]
+        self._processes: List[Optional[asyncio.subprocess.Process]] = [None] * count
+        self._tasks: List[asyncio.Task] = []
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    async def start(self):
+        self._session = aiohttp.ClientSession()
+        for index in range(self.count):
+            self._tasks.append(asyncio.create_task(self._supervise(index)))
+            self._tasks.append(asyncio.create_task(self._forward(index)))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for process in self._processes:
+            if process is not None and process.returncode is None:
+                process.send_signal(signal.SIGTERM)
+        for process in self._processes:
+            if process is None:
+                continue
+            try:
+                await asyncio.wait_for(process.wait(), 15)
+            except asyncio.TimeoutError:
+                process.kill()
+        if self._session is not None:
+            await self._session.close()
+
+    def dispatch(self, update: Dict[str, Any]):
+        """Передать обновление обработчику его клиента"""
+        self._queues[shard_of(update, self.count)].put_nowait(update)
+
+    def pending(self) -> int:
+        return sum(queue.qsize() for queue in self._queues)
+
+    async def _supervise(self, index: int):
+        env = {**os.environ, 'BOT_WORKER_INDEX': str(index)}
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot.py')
+        while True:
+            process = await asyncio.create_subprocess_exec(sys.executable, script, env=env)
+            self._processes[index] = process
+            code = await process.wait()
+            logging.warning('Обработчик %s завершился с кодом %s, перезапуск', index, code)
+            await asyncio.sleep(1)
+
+    async def _forward(self, index: int):
+        url = f'http://127.0.0.1:{self.port_base + index}{WORKER_PATH}'
+        headers = {SECRET_HEADER: self.secret}
+        queue = self._queues[index]
+        while True:
+            update = await queue.get()
+            delay = 0.2
+            # Пока обработчик запускается или перезапускается, повторяем
+            while True:
+                try:
+                    async with self._session.post(url, json=update, headers=headers) as response:
+                        if response.status == 200:
+                            break
+                        logging.warning('Обработчик %s ответил %s', index, response.status)
+                except aiohttp.ClientError:
+                    pass
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 5)
+
+
+async def poll_updates(bot: Bot, pool: WorkerPool, allowed_updates: List[str], polling_timeout: int = 30):
+    """Long polling без обработки: обновления только раздаются обработчикам"""
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(
+                offset=offset,
+                timeout=polling_timeout,
+                allowed_updates=allowed_updates,
+                request_timeout=int(bot.session.timeout + polling_timeout),
+            )
+        except Exception:
+            logging.exception('Ошибка получения обновлений')
+            await asyncio.sleep(5)
+            continue
+        for update in updates:
+            pool.dispatch(update_json(update))
+            offset = update.update_id + 1
@@ -0,0 +1,204 @@
+import asyncio
+import json
+import logging
+import time
+from copy import copy
+from typing import Any, Dict, Optional, Set, Tuple, Union
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+import database as db
+
+
+def _storage_key(key: StorageKey) -> str:
+    return ':'.join(str(part) for part in (
+        key.bot_id, key.chat_id, key.user_id, key.thread_id, key.business_connection_id, key.destiny
+    ))
+
+
+def _session_ttl(state: Optional[str], ttls: Dict[str, float], default_ttl: float) -> float:
+    """Срок жизни диалога по группе его состояния ('OrderStates:waiting_city' -> 'OrderStates')"""
+    if not state:
+        return default_ttl
+    return ttls.get(state.split(':', 1)[0], default_ttl)
+
+
+def _session_size(state: Optional[str], data: Dict[str, Any]) -> int:
+    """Примерный размер диалога в байтах (как он хранится в базе)"""
+    return len(state or '') + len(json.dumps(data, ensure_ascii=False, default=str))
+
+
+class _Record:
+    __slots__ = ('state', 'data', 'touched')
+
+    def __init__(self, state: Optional[str] = None, data: Optional[Dict[str, Any]] = None, touched: float = None):
+        self.state = state
+        self.data = data or {}
+        self.touched = touched or time.time()
+
+
+class SQLiteStorage(BaseStorage):
+    """Хранилище FSM в SQLite с кэшем в памяти.
+
+    Чтение идет из кэша (при промахе запись один раз читается из базы).
+    Изменения помечают ключ грязным; раз в flush_interval секунд все грязные
+    ключи записываются одной транзакцией через executemany, так что несколько
+    update_data подряд стоят одной записи.
+    """
+
+    def __init__(self, flush_interval: float, ttls: Dict[str, float], default_ttl: float):
+        self.flush_interval = flush_interval
+        self.ttls = ttls
+        self.default_ttl = default_ttl
+        self._records: Dict[str, _Record] = {}
+        self._dirty: Set[str] = set()
+        self._flush_task: Optional[asyncio.Task] = None
+        self._closed = False
+
+    async def _record(self, key: StorageKey) -> _Record:
+        storage_key = _storage_key(key)
+        record = self._records.get(storage_key)
+        if record is None:
+            row = await db.get_fsm_record(storage_key)
+            # Пока шло чтение, запись могла появиться
+            record = self._records.get(storage_key)
+            if record is None:
+                record = _Record(row['state'], json.loads(row['data']), row['updated_at']) if row else _Record()
+                self._records[storage_key] = record
+        return record
+
+    def _mark_dirty(self, key: StorageKey):
+        self._dirty.add(_storage_key(key))
+        if self._flush_task is None and not self._closed:
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = await self._record(key)
+        record.state = state.state if isinstance(state, State) else state
+        record.touched = time.time()
+        self._mark_dirty(key)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._record(key)).state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        record = await self._record(key)
+        record.data = data.copy()
+        record.touched = time.time()
+        self._mark_dirty(key)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return (await self._record(key)).data.copy()
+
+    async def get_value(self, storage_key: StorageKey, dict_key: str, default: Optional[Any] = None) -> Optional[Any]:
+        return copy((await self._record(storage_key)).data.get(dict_key, default))
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        self._flush_task = None
+        try:
+            await self.flush()
+        except Exception:
+            logging.exception('Не удалось сохранить состояния диалогов')
+            if self._dirty and not self._closed:
+                self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def flush(self):
+        """Записать все измененные состояния в базу"""
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, set()
+        now = time.time()
+        records, deleted = [], []
+        for storage_key in dirty:
+            record = self._records.get(storage_key)
+            if record is None or (record.state is None and not record.data):
+                deleted.append(storage_key)
+                continue
+            try:
+                records.append((storage_key, record.state, json.dumps(record.data, ensure_ascii=False), now))
+            except (TypeError, ValueError):
+                logging.exception('Состояние %s не сериализуется в JSON и не будет сохранено', storage_key)
+        try:
+            await db.save_fsm_records(records, deleted)
+        except Exception:
+            # Не потерять изменения: попробуем еще раз при следующем сбросе
+            self._dirty |= dirty
+            raise
+
+    async def evict_expired(self) -> Tuple[int, int]:
+        """Удалить брошенные диалоги; вернуть (количество, примерно освобождено байт)"""
+        now = time.time()
+        count, size = 0, 0
+        for row in await db.delete_expired_fsm_records(self.ttls, self.default_ttl, now):
+            # Изменился во время удаления - будет записан заново при сбросе
+            if row['key'] in self._dirty:
+                continue
+            self._records.pop(row['key'], None)
+            count += 1
+            size += row['size']
+        # Кэш в памяти: пустые записи после промахов и еще не удаленные из базы
+        for storage_key, record in list(self._records.items()):
+            if storage_key in self._dirty:
+                continue
+            if record.touched < now - _session_ttl(record.state, self.ttls, self.default_ttl):
+                del self._records[storage_key]
+        return count, size
+
+    async def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+
+
+class MemoryTTLStorage(MemoryStorage):
+    """MemoryStorage, из которого удаляются брошенные диалоги"""
+
+    def __init__(self, ttls: Dict[str, float], default_ttl: float):
+        super().__init__()
+        self.ttls = ttls
+        self.default_ttl = default_ttl
+        self._touched: Dict[StorageKey, float] = {}
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await super().set_state(key, state)
+        self._touched[key] = time.time()
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        await super().set_data(key, data)
+        self._touched[key] = time.time()
+
+    async def evict_expired(self) -> Tuple[int, int]:
+        """Удалить брошенные диалоги; вернуть (количество, примерно освобождено байт)"""
+        now = time.time()
+        count, size = 0, 0
+        for key, record in list(self.storage.items()):
+            # Записи, созданные одним чтением, отсчитываются с первой проверки
+            touched = self._touched.setdefault(key, now)
+            if touched >= now - _session_ttl(record.state, self.ttls, self.default_ttl):
+                continue
+            del self.storage[key]
+            del self._touched[key]
+            if record.state or record.data:
+                count += 1
+                size += _session_size(record.state, record.data)
+        return count, size
+
+
+async def run_session_sweeper(storage: Union[SQLiteStorage, MemoryTTLStorage], interval: float):
+    """Периодически удалять брошенные диалоги"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            count, size = await storage.evict_expired()
+        except Exception:
+            logging.exception('Ошибка при удалении брошенных диалогов')
+            continue
+        if count:
+            logging.info('Удалено брошенных диалогов: %s, освобождено ~%.1f КБ', count, size / 1024)
@@ -0,0 +1,59 @@
+import hmac
+import logging
+from typing import Any, Callable, Dict
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+
+async def health(request: web.Request) -> web.Response:
+    """Проверка живости для хостинга (healthCheckPath)"""
+    return web.json_response({'status': 'ok'})
+
+
+def create_health_app() -> web.Application:
+    """Приложение только с /health (для режима polling на web-хостинге)"""
+    app = web.Application()
+    app.router.add_get('/health', health)
+    return app
+
+
+def create_webhook_app(bot: Bot, dp: Dispatcher, path: str, secret: str) -> web.Application:
+    """Приложение, принимающее обновления от Telegram.
+
+    Запрос без правильного X-Telegram-Bot-Api-Secret-Token отклоняется с 401.
+    На остальные сразу отвечаем 200, а обновление обрабатывается в фоне.
+    """
+    app = create_health_app()
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=secret,
+        handle_in_background=True,
+    ).register(app, path=path)
+    # Запуск и остановка диспетчера (в т.ч. сохранение состояний) вместе с приложением
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+def create_front_app(dispatch: Callable[[Dict[str, Any]], None], path: str, secret: str) -> web.Application:
+    """Приложение front-процесса: проверяет секрет и раздает обновления обработчикам"""
+    app = create_health_app()
+
+    async def handle(request: web.Request) -> web.Response:
+        if not hmac.compare_digest(request.headers.get('X-Telegram-Bot-Api-Secret-Token', ''), secret):
+            return web.Response(body='Unauthorized', status=401)
+        dispatch(await request.json())
+        return web.json_response({})
+
+    app.router.add_post(path, handle)
+    return app
+
+
+async def start_server(app: web.Application, host: str, port: int) -> web.AppRunner:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info('HTTP-сервер слушает %s:%s', host, port)
+    return runner